@@ -0,0 +1,113 @@
+/*
+Canvas grid that is drawn from delta frames, see CanvasGridCustom.render_delta in server.py.
+The obstacles of a full frame are drawn once on a static canvas. Empty cells are drawn on a base
+canvas, on which only the cells in a frame are repainted. The customers are kept per cell and
+drawn on a canvas of their own every frame.
+*/
+var DeltaCanvasModule = function(canvas_width, canvas_height, grid_width, grid_height) {
+	// Create the element
+	// ------------------
+
+	// Create the tags with absolute positioning :
+	var canvas_tag = `<canvas width="${canvas_width}" height="${canvas_height}" class="world-grid"/>`
+
+	var parent_div_tag = '<div style="height:' + canvas_height + 'px;" class="world-grid-parent"></div>'
+
+	// Append them to body, the static canvas at the bottom:
+	var static_canvas = $(canvas_tag)[0];
+	var base_canvas = $(canvas_tag)[0];
+	var canvas = $(canvas_tag)[0];
+	var interaction_canvas = $(canvas_tag)[0];
+	var parent = $(parent_div_tag)[0];
+
+	$("#elements").append(parent);
+	parent.append(static_canvas);
+	parent.append(base_canvas);
+	parent.append(canvas);
+	parent.append(interaction_canvas);
+
+	// Create the contexts for the obstacles, empty cells, customers and interactions and the
+	// drawing controllers:
+	var base_context = base_canvas.getContext("2d");
+	var interactionHandler = new InteractionHandler(canvas_width, canvas_height, grid_width, grid_height, interaction_canvas.getContext("2d"));
+	var staticDraw = new GridVisualization(canvas_width, canvas_height, grid_width, grid_height, static_canvas.getContext("2d"), null);
+	var baseDraw = new GridVisualization(canvas_width, canvas_height, grid_width, grid_height, base_context, null);
+	var canvasDraw = new GridVisualization(canvas_width, canvas_height, grid_width, grid_height, canvas.getContext("2d"), interactionHandler);
+
+	// cell size as used by GridVisualization
+	var cell_width = Math.floor(canvas_width / grid_width);
+	var cell_height = Math.floor(canvas_height / grid_height);
+
+	// portrayals of the cells with customers, by "x,y", and the portrayal of an empty cell of the
+	// current model
+	var customers = {};
+	var empty = {};
+
+	// Clears a cell of the base canvas and draws the given portrayals in it. Drawing is clipped to
+	// the cell, so repainting a cell never touches its neighbours. drawLayer flips the y
+	// coordinate of the portrayals it draws, so it only gets copies.
+	var paintCell = function(x, y, portrayals) {
+		var x0 = x * cell_width;
+		var y0 = (grid_height - y - 1) * cell_height;
+		base_context.clearRect(x0, y0, cell_width, cell_height);
+		if (!portrayals.length)
+			return;
+
+		base_context.save();
+		base_context.beginPath();
+		base_context.rect(x0, y0, cell_width, cell_height);
+		base_context.clip();
+		baseDraw.drawLayer(portrayals.map(portrayal => Object.assign({}, portrayal)));
+		base_context.restore();
+	};
+
+	this.render = function(data) {
+		if (data.full) {
+			customers = {};
+			empty = data.empty;
+			staticDraw.resetCanvas();
+			staticDraw.drawLayer(data.static);
+			baseDraw.resetCanvas();
+		}
+
+		// cells with customers are cleared on the base canvas, their customers are drawn on top
+		data.cells.forEach(function(cell) {
+			var key = cell[0] + "," + cell[1];
+			paintCell(cell[0], cell[1], []);
+			if (cell[2].length)
+				customers[key] = cell[2];
+			else
+				delete customers[key];
+		});
+
+		// empty cells only carry their score, label them using the portrayal of an empty cell
+		data.scores.forEach(function(cell) {
+			var portrayal = Object.assign({}, empty);
+			portrayal.x = cell[0];
+			portrayal.y = cell[1];
+			portrayal.text = "(" + cell[0] + ", " + cell[1] + ") - " + cell[2];
+			delete customers[cell[0] + "," + cell[1]];
+			paintCell(cell[0], cell[1], [portrayal]);
+		});
+
+		var layers = {};
+		for (var key in customers) {
+			customers[key].forEach(function(portrayal) {
+				(layers[portrayal.Layer] = layers[portrayal.Layer] || []).push(Object.assign({}, portrayal));
+			});
+		}
+
+		canvasDraw.resetCanvas();
+		for (var layer in layers)
+			canvasDraw.drawLayer(layers[layer]);
+		canvasDraw.drawGridLines("#eee");
+	};
+
+	this.reset = function() {
+		customers = {};
+		staticDraw.resetCanvas();
+		baseDraw.resetCanvas();
+		canvasDraw.resetCanvas();
+	};
+
+};
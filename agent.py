@@ -1,5 +1,6 @@
 from mesa import Model, Agent
 
+from population import ShoppingList
 import route
 
 
@@ -29,6 +30,8 @@ class Customer(Agent):
         patience (float <- [0, 1]): patience of agent, higher is more patient
         patience_0 (float <- [0, 1]): patience of agent on t=0, higher is more patient
         personal_compliance (float <- [0, 1]): personal level compliance, higher is more compliant
+        planner (route.IncrementalPlanner): search state towards the current goal, kept between
+            steps when the model uses the route method "dstar"
         vaccinated (bool): if the customer is vaccinated or not
         vision (int <- min. 3): amount of grid cells customer can see other customers
 
@@ -49,14 +52,15 @@ class Customer(Agent):
         self.personal_compliance = personal_compliance
         self.pos = pos
         self.routefinder = None
+        self.planner = None
         self.shop_cor_list = []
         self.vision = vision
         self.vaccinated = vaccinated
 
         # adds a maximum of len_shoplist items to a shopping list
         shop_list = []
+        shelf_list = self.model.floorplan.shelf_types
         while len(shop_list) < len_shoplist:
-            shelf_list = list(self.model.coord_shelf)
             random_shop = self.random.choice(shelf_list)
             if random_shop != self.EXIT:
                 shop_list.append(random_shop)
@@ -76,14 +80,14 @@ class Customer(Agent):
                 new_shop_list.append(value)
 
         for item in new_shop_list:
-            cor_list = list(self.model.coord_shelf.get(item))
+            cor_list = self.model.floorplan.access_cells[item]
             self.shop_cor_list.append(self.random.choice(cor_list))
 
         # do a random permutation of the shopping list
         self.permute_shopping_list(max(1, int(len_shoplist/4)))
 
         # add the exit at the end to make sure that the exit is visited last
-        exit_list = list(self.model.coord_shelf.get(self.EXIT))
+        exit_list = self.model.floorplan.access_cells[self.EXIT]
         self.shop_cor_list.append(self.random.choice(exit_list))
 
     def get_path_multiplier(self):
@@ -140,7 +144,8 @@ class Customer(Agent):
 
     def random_move(self, moore=False):
         """Moves the agent randomly to a new location on the grid"""
-        steps = self.model.grid.get_neighborhood(self.pos, moore)
+        grid = self.model.grid
+        steps = [x for x in grid.get_neighborhood(self.pos, moore) if grid.walkable[x]]
         step = self.random.choice(steps)
         self.model.grid.move_agent(self, step)
 
@@ -149,8 +154,9 @@ class Customer(Agent):
         if not self.routefinder:
             self.routefinder = route.Route(
                 self.model, self.pos, self.shop_cor_list[0], self.model.grid,
-                forbidden_type=[Obstacle]
+                planner=self.planner
             )
+            self.planner = self.routefinder.planner
 
         # check if route exists, if so move agent towards the goal
         if self.routefinder.shortest:
@@ -180,8 +186,12 @@ class Customer(Agent):
                     forbidden_cells = self.model.grid.get_forbidden_cells(self.pos, self.vision)
                     alternative_route = route.Route(
                         self.model, self.pos, self.shop_cor_list[0], self.model.grid,
-                        forbidden_type=[Obstacle], forbidden_cells=forbidden_cells
+                        forbidden_cells=forbidden_cells, planner=self.planner
                     )
+                    self.planner = alternative_route.planner
+                    step_stats = self.model.step_stats
+                    if step_stats is not None:
+                        step_stats["alternative_routes"] += 1
 
                     # check if a alternative route was found
                     if alternative_route.shortest:
@@ -192,6 +202,8 @@ class Customer(Agent):
                         if alternative_score < current_score:
                             self.routefinder = alternative_route
                             self.patience *= 0.95
+                            if step_stats is not None:
+                                step_stats["route_swaps"] += 1
 
                     self.routefinder.move_agent(self)
 
@@ -216,9 +228,73 @@ class Customer(Agent):
                 self.model.agents_to_remove.append(self)
 
 
+def _population_field(name):
+    """Property that reads and writes the row of a customer in the array name of the population
+    store of its model
+    """
+    def getter(self):
+        return getattr(self.population, name)[self.row].item()
+
+    def setter(self, value):
+        getattr(self.population, name)[self.row] = value
+
+    return property(getter, setter)
+
+
+class ArrayCustomer(Customer):
+    """Customer whose state is kept in a row of the population store (population.Population) of
+    the model, so it can be processed in bulk. Behaves exactly like a Customer
+
+    Args:
+        unique_id (int): a unique identifier for this agent
+        model: model object this agent is part of, with a population store
+        *args: remaining arguments of Customer
+        **kwargs: remaining keyword arguments of Customer
+
+    Attributes:
+        population (population.Population): store of the state of the customer
+        row (int): row of the customer in the store
+
+    """
+    patience = _population_field("patience")
+    patience_0 = _population_field("patience_0")
+    basic_compliance = _population_field("basic_compliance")
+    personal_compliance = _population_field("personal_compliance")
+    vaccinated = _population_field("vaccinated")
+    is_problematic_contact = _population_field("is_problematic_contact")
+    vision = _population_field("vision")
+    avoid_radius = _population_field("avoid_radius")
+
+    def __init__(self, unique_id, model, *args, **kwargs):
+        self.population = model.population
+        self.row = self.population.add()
+        super().__init__(unique_id, model, *args, **kwargs)
+
+    @property
+    def pos(self):
+        x, y = self.population.pos[self.row].tolist()
+        return None if x < 0 else (x, y)
+
+    @pos.setter
+    def pos(self, pos):
+        self.population.pos[self.row] = (-1, -1) if pos is None else pos
+
+    @property
+    def shop_cor_list(self):
+        return ShoppingList(self.population, self.row)
+
+    @shop_cor_list.setter
+    def shop_cor_list(self, cells):
+        self.population.shop_first[self.row] = 0
+        self.population.shop_end[self.row] = 0
+        for cell in cells:
+            self.shop_cor_list.append(cell)
+
+
 class Obstacle(Agent):
     """
-    Agent that describes inaccesible area or shop shelf in supermarket
+    Agent that describes inaccesible area or shop shelf in supermarket. Obstacles are not placed
+    on the grid, they are only used to draw the obstacle layer of the grid
 
     Args:
         unique_id (int): a unique identifier for this agent
@@ -0,0 +1,177 @@
+import argparse
+import inspect
+import json
+import math
+import os
+import sys
+import time
+
+from model import CovidSupermarketModel
+import ensemble
+
+
+# arguments of the model that are set by the runner itself
+RESERVED_PARAMS = ["floorplan", "width", "height", "seed"]
+
+
+def model_params():
+    """Returns the names of the keyword arguments of the model that can be set per batch """
+    return [
+        name for name in inspect.signature(CovidSupermarketModel).parameters
+        if name not in RESERVED_PARAMS
+    ]
+
+
+def parse_param(text):
+    """Parses a model parameter given as name=value. The value is read as JSON, so numbers and
+    booleans (true, false) keep their type, anything else is used as a string
+
+    Args:
+        text (string): parameter, e.g. "N_customers=50" or "route_method=heap"
+
+    Returns:
+        name (string): name of the parameter
+        value: value of the parameter
+
+    """
+    name, separator, value = text.partition("=")
+    if not separator or name not in model_params():
+        raise argparse.ArgumentTypeError(
+            "expected name=value with name one of {}".format(", ".join(model_params()))
+        )
+
+    try:
+        return name, json.loads(value)
+    except ValueError:
+        return name, value
+
+
+def parse_seeds(text):
+    """Parses a list of seeds, given as comma separated seeds and inclusive ranges
+
+    Args:
+        text (string): seeds, e.g. "0-99" or "1,5,10-12"
+
+    Returns:
+        seeds (list of ints): seeds in the given order
+
+    """
+    seeds = []
+    try:
+        for part in text.split(","):
+            first, separator, last = part.partition("-")
+            if separator:
+                seeds.extend(range(int(first), int(last) + 1))
+            else:
+                seeds.append(int(first))
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected seeds like 0-99 or 1,5,10-12")
+
+    return seeds
+
+
+def summarize(data):
+    """Summary metrics of a single run
+
+    Args:
+        data (pd.DataFrame): model variables collected during the run, one row for the initial
+            state and one per step
+
+    Returns:
+        summary (dict): total, mean and maximum number of problematic contacts per step
+
+    """
+    contacts = data["n_problematic_contacts"]
+    return {
+        "total_problematic_contacts": int(contacts.sum()),
+        "mean_problematic_contacts": float(contacts.mean()),
+        "max_problematic_contacts": int(contacts.max())
+    }
+
+
+def run_batch(floorplan_path, params, seeds, n_steps, output, n_workers=None, series=False,
+              burn_in=0):
+    """Runs a model per seed and writes one JSON line per finished run to output as soon as it
+    completes, so the results never have to be kept in memory. Runs finish in arbitrary order,
+    every line carries the seed of its run
+
+    Args:
+        floorplan_path (string): csv file containing layout of supermarket
+        params (dict): keyword arguments for the model, shared by all runs
+        seeds (list of ints): seed per run
+        n_steps (int): number of steps per run
+        output (file): text file to write the lines to
+        n_workers (int, optional): number of worker processes, defaults to the number of cores
+        series (boolean): also write the value of every collected variable, for the initial
+            state and every step
+        burn_in (int): number of steps all runs share, see ensemble.run_job(). No burn-in is
+            shared by default
+
+    Returns:
+        n_runs (int): number of runs written
+
+    """
+    jobs = []
+    for seed in seeds:
+        job = (seed, params, n_steps, seed)
+        if burn_in:
+            job += ((burn_in, seeds[0]),)
+        jobs.append(job)
+
+    # all runs share the same burn-in, so split them evenly over the workers in one chunk each,
+    # then every worker only runs the burn-in once
+    chunksize = 1
+    if burn_in:
+        chunksize = math.ceil(len(jobs) / (n_workers or os.cpu_count() or 1))
+
+    time_start = time.time()
+    n_runs = 0
+    for seed, data in ensemble.run_ensemble(jobs, floorplan_path, n_workers, chunksize):
+        line = {"seed": seed, "params": params, "steps": n_steps}
+        line.update(summarize(data))
+        if series:
+            line["series"] = {name: data[name].tolist() for name in data.columns}
+        line["elapsed"] = round(time.time() - time_start, 3)
+
+        output.write(json.dumps(line) + "\n")
+        output.flush()
+        n_runs += 1
+
+    return n_runs
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Runs the supermarket model without server for a list of seeds, and writes "
+                    "one JSON line per finished run"
+    )
+    parser.add_argument("--floorplan", default="data/albert_excel_test.csv",
+                        help="csv file containing layout of supermarket")
+    parser.add_argument("--param", "-p", type=parse_param, action="append", default=[],
+                        metavar="NAME=VALUE",
+                        help="keyword argument of the model, can be repeated. Parameters that "
+                             "are not given keep the defaults of the model")
+    parser.add_argument("--seeds", type=parse_seeds, default=[0],
+                        help="seeds of the runs, e.g. 0-99 or 1,5,10-12 (default: 0)")
+    parser.add_argument("--steps", type=int, default=200, help="number of steps per run")
+    parser.add_argument("--workers", type=int,
+                        help="number of worker processes, defaults to the number of cores")
+    parser.add_argument("--burn-in", type=int, default=0,
+                        help="number of steps shared by all runs, forked from the first seed")
+    parser.add_argument("--series", action="store_true",
+                        help="include the collected variables of every step")
+    parser.add_argument("--output", "-o", help="file to write the lines to, defaults to stdout")
+    args = parser.parse_args()
+
+    if not 0 <= args.burn_in < args.steps:
+        parser.error("--burn-in must be at least 0 and less than --steps")
+
+    output = open(args.output, "w") if args.output else sys.stdout
+    try:
+        run_batch(
+            args.floorplan, dict(args.param), args.seeds, args.steps, output, args.workers,
+            args.series, args.burn_in
+        )
+    finally:
+        if args.output:
+            output.close()
@@ -0,0 +1,307 @@
+import argparse
+import json
+import platform
+import random
+import statistics
+import sys
+import timeit
+import numpy as np
+
+from model import CovidSupermarketModel
+import floorplan as floorplans
+import route
+
+
+# settings of the full model runs, on top of the defaults of CovidSupermarketModel
+MACRO_SETTINGS = [
+    {"N_customers": 50, "len_shoplist": 10, "vision": 3},
+    {"N_customers": 100, "len_shoplist": 10, "vision": 3},
+    {"N_customers": 150, "len_shoplist": 10, "vision": 5},
+    {"N_customers": 100, "len_shoplist": 2, "vision": 7},
+    {"N_customers": 100, "len_shoplist": 10, "vision": 3, "route_method": "flowfield"},
+    {"N_customers": 100, "len_shoplist": 10, "vision": 3, "route_method": "dstar"},
+    {"N_customers": 100, "len_shoplist": 10, "vision": 3, "route_method": "hpa"},
+]
+
+
+def time_call(function, number, repeat):
+    """Times a function
+
+    Args:
+        function: function without arguments to time
+        number (int): number of calls per measurement
+        repeat (int): number of measurements
+
+    Returns:
+        result (dict): median and minimum time per call in seconds, number and repeat
+
+    """
+    times = [total / number for total in timeit.Timer(function).repeat(repeat, number)]
+    return {
+        "seconds": statistics.median(times), "min": min(times), "number": number,
+        "repeat": repeat
+    }
+
+
+def warmed_up_model(floorplan, n_steps=20, seed=0, **params):
+    """Returns a seeded model that already ran n_steps, so customers are spread over the store
+
+    Args:
+        floorplan (Floorplan): compiled floorplan
+        n_steps (int): number of steps to run
+        seed (int): seed of the model
+        **params: keyword arguments for the model
+
+    Returns:
+        model (CovidSupermarketModel): model after n_steps
+
+    """
+    model = CovidSupermarketModel(
+        floorplan, floorplan.width, floorplan.height, seed=seed, **params
+    )
+    model.run_model(n_steps)
+    return model
+
+
+def route_pairs(model, n_pairs, seed=0):
+    """Draws fixed start and goal pairs of connected walkable cells
+
+    Args:
+        model (CovidSupermarketModel): model to draw the cells from
+        n_pairs (int): number of pairs
+        seed (int): seed for drawing the pairs
+
+    Returns:
+        pairs (list of tuples (start, goal)): start and goal cells
+
+    """
+    rng = random.Random(seed)
+    cells = list(zip(*[axis.tolist() for axis in np.nonzero(model.grid.walkable)]))
+    pairs = []
+    while len(pairs) < n_pairs:
+        start, goal = rng.choice(cells), rng.choice(cells)
+        if start != goal and model.get_flow_field(goal)[start] > 0:
+            pairs.append((start, goal))
+
+    return pairs
+
+
+def micro_benchmarks(floorplan, repeat=5):
+    """Times the hot paths of a step on a warmed up model
+
+    Args:
+        floorplan (Floorplan): compiled floorplan
+        repeat (int): number of measurements per benchmark
+
+    Returns:
+        results (dict {name: dict}): timing per benchmark, see time_call()
+
+    """
+    results = {}
+    model = warmed_up_model(floorplan, N_customers=100)
+    pairs = route_pairs(model, 20)
+
+    def find_routes(method):
+        def run():
+            model.random.seed(0)
+            for start, goal in pairs:
+                route.Route(model, start, goal, model.grid, method=method)
+        return run
+
+    # the flow fields of the goals and the abstract graph are kept by the model, they are built
+    # before timing so only the search itself is measured
+    for method in ("astar", "heap", "flowfield", "dstar", "hpa"):
+        find_routes(method)()
+        results["route_{}_20_pairs".format(method)] = time_call(find_routes(method), 1, repeat)
+
+    # move a customer back and forth between its cell and a free neighbouring cell
+    customer = next(
+        customer for customer in model.customers
+        if model.get_unoccupied(customer.pos, 1, False)
+    )
+    cells = [customer.pos, model.get_unoccupied(customer.pos, 1, False)[0]]
+
+    def move_agent():
+        for cell in cells[1], cells[0]:
+            model.grid.move_agent(customer, cell)
+
+    results["move_agent_x2"] = time_call(move_agent, 1000, repeat)
+
+    for vision in (3, 7):
+        def get_forbidden_cells():
+            for customer in model.customers:
+                model.grid.get_forbidden_cells(customer.pos, vision)
+
+        results["forbidden_cells_vision_{}".format(vision)] = time_call(
+            get_forbidden_cells, 10, repeat
+        )
+
+    heatgrid = model.heatgrid.copy()
+    results["problematic_contacts"] = time_call(model.problematic_contacts, 100, repeat)
+    model.heatgrid = heatgrid
+
+    return results
+
+
+def macro_benchmarks(floorplan, n_steps=100, repeat=1, settings=MACRO_SETTINGS):
+    """Times full seeded model runs. The sum of the problematic contacts of a run is stored as
+    checksum, so a change in behaviour shows up next to a change in speed
+
+    Args:
+        floorplan (Floorplan): compiled floorplan
+        n_steps (int): number of steps per run
+        repeat (int): number of runs per setting
+        settings (list of dicts): keyword arguments for the model per benchmark
+
+    Returns:
+        results (dict {name: dict}): timing and checksum per benchmark, see time_call()
+
+    """
+    results = {}
+    for params in settings:
+        name = "run_model_{}_steps_".format(n_steps) + "_".join(
+            "{}_{}".format(key, value) for key, value in sorted(params.items())
+        )
+        runs = []
+
+        def run_model():
+            model = CovidSupermarketModel(
+                floorplan, floorplan.width, floorplan.height, seed=0, **params
+            )
+            model.run_model(n_steps)
+            runs.append(int(model.datacollector.get("n_problematic_contacts").sum()))
+
+        results[name] = time_call(run_model, 1, repeat)
+        results[name]["checksum"] = runs[0]
+
+    return results
+
+
+def compare(results, baseline, tolerance=0.2):
+    """Compares results with a baseline and prints the ratio of the times per benchmark
+
+    Args:
+        results (dict): results of run_benchmarks()
+        baseline (dict): earlier results of run_benchmarks()
+        tolerance (float): relative slowdown that is still accepted
+
+    Returns:
+        regressions (list): names of the benchmarks that are slower than accepted, whose
+            checksum changed, or that are missing from either the results or the baseline
+
+    """
+    regressions = []
+    width = max(map(len, list(results["results"]) + list(baseline["results"]) + ["benchmark"]))
+    print("{:<{}} {:>12} {:>12} {:>7}".format("benchmark", width, "baseline", "current", "ratio"))
+    for name, result in results["results"].items():
+        if name not in baseline["results"]:
+            print("{:<{}} {:>12} {:>12.6f}  not in baseline".format(
+                name, width, "-", result["seconds"])
+            )
+            regressions.append(name)
+            continue
+
+        reference = baseline["results"][name]
+        ratio = result["seconds"] / reference["seconds"]
+        flag = ""
+        if ratio > 1 + tolerance:
+            flag = "  slower"
+            regressions.append(name)
+        if reference.get("checksum") != result.get("checksum"):
+            flag += "  checksum {} != {}".format(result.get("checksum"), reference.get("checksum"))
+            regressions.append(name)
+        print("{:<{}} {:>12.6f} {:>12.6f} {:>7.2f}{}".format(
+            name, width, reference["seconds"], result["seconds"], ratio, flag)
+        )
+
+    for name, reference in baseline["results"].items():
+        if name not in results["results"]:
+            print("{:<{}} {:>12.6f} {:>12}  not run".format(
+                name, width, reference["seconds"], "-")
+            )
+            regressions.append(name)
+
+    return regressions
+
+
+def baseline_path(quick=False):
+    """Returns the default baseline file. Quick runs use shorter model runs, so their macro
+    benchmarks and checksums are compared with a baseline of their own
+
+    Args:
+        quick (boolean): baseline of quick runs
+
+    Returns:
+        path (string): json file with the baseline
+
+    """
+    return "results/benchmark_baseline{}.json".format("_quick" if quick else "")
+
+
+def run_benchmarks(floorplan_path="data/albert_excel_test.csv", quick=False):
+    """Runs all benchmarks
+
+    Args:
+        floorplan_path (string): csv file containing layout of supermarket
+        quick (boolean): fewer measurements and shorter model runs
+
+    Returns:
+        results (dict): description of the environment ("meta") and results per benchmark
+
+    """
+    floorplan = floorplans.load(floorplan_path)
+    n_steps = 30 if quick else 100
+    results = micro_benchmarks(floorplan, repeat=3 if quick else 5)
+    results.update(macro_benchmarks(floorplan, n_steps))
+
+    return {
+        "meta": {
+            "floorplan": floorplan_path, "quick": quick, "python": sys.version.split()[0],
+            "numpy": np.__version__, "platform": platform.platform()
+        },
+        "results": results
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks of the supermarket model")
+    parser.add_argument("--floorplan", default="data/albert_excel_test.csv",
+                        help="csv file containing layout of supermarket")
+    parser.add_argument("--quick", action="store_true", help="fewer and shorter runs")
+    parser.add_argument("--output", help="json file to write the results to")
+    parser.add_argument("--baseline",
+                        help="json file with results to compare with, defaults to "
+                             "results/benchmark_baseline.json (benchmark_baseline_quick.json "
+                             "with --quick)")
+    parser.add_argument("--save-baseline", action="store_true",
+                        help="store the results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="relative slowdown that is still accepted")
+    args = parser.parse_args()
+    if args.baseline is None:
+        args.baseline = baseline_path(args.quick)
+
+    results = run_benchmarks(args.floorplan, args.quick)
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as file:
+            json.dump(results, file, indent=2)
+    else:
+        try:
+            with open(args.baseline) as file:
+                baseline = json.load(file)
+        except FileNotFoundError:
+            print(json.dumps(results, indent=2))
+            sys.exit("No baseline {}, store one with --save-baseline".format(args.baseline))
+        if baseline["meta"]["quick"] != args.quick:
+            sys.exit("Baseline {} was {}recorded with --quick".format(
+                args.baseline, "not " if args.quick else "")
+            )
+
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print("\n{} regression(s): {}".format(len(regressions), ", ".join(regressions)))
+            sys.exit(1)
@@ -60,17 +60,8 @@ def load_floorplan(map):
         grid (2D list): grid with corresponding values of input map
 
     """
-    grid = []
     with open(map, encoding='utf-8-sig', newline="") as file:
-        reader = csv.reader(file)
+        rows = list(csv.reader(file))
 
-        # create a list for each possible x value in the grid
-        for row in reader:
-            for item in row:
-                grid.append([item])
-            grid_len = len(grid)
-            break
-        for row in reader:
-            for i in range(grid_len):
-                grid[i].insert(0, row[i])
-    return grid
+    # create a list for each possible x value in the grid, the last row of the file is y = 0
+    return [list(column) for column in zip(*reversed(rows))]
@@ -0,0 +1,134 @@
+from collections import OrderedDict
+import json
+import multiprocessing
+import numpy as np
+
+from model import CovidSupermarketModel
+import floorplan
+
+
+# floorplan of the worker process, loaded once by init_worker
+_floorplan = None
+
+# snapshots of burned-in models of the worker process, by parameters and burn-in
+_snapshots = OrderedDict()
+SNAPSHOT_CACHE_SIZE = 4
+
+
+def job_seed(base_seed, *key):
+    """Deterministic seed of a single run, independent of the order in which runs are executed
+
+    Args:
+        base_seed (int): seed of the whole ensemble
+        *key (int): indices identifying the run, e.g. parameter, sample and replicate index
+
+    Returns:
+        seed (int): seed for the random number generator of the model
+
+    """
+    return int(np.random.SeedSequence([base_seed, *key]).generate_state(1)[0])
+
+
+def init_worker(floorplan_path):
+    """Loads the compiled floorplan of the supermarket once per worker process
+
+    Args:
+        floorplan_path (string): csv file containing layout of supermarket
+
+    """
+    global _floorplan
+    _floorplan = floorplan.load(floorplan_path)
+
+
+def burned_in_snapshot(params, n_burn_in, seed):
+    """Returns a snapshot of a model that ran for n_burn_in steps. The last few snapshots are
+    kept by the worker process, so the replicates of a parameter set share a single burn-in
+
+    Args:
+        params (dict): keyword arguments for the model
+        n_burn_in (int): number of steps to run before taking the snapshot
+        seed (int): seed of the model during the burn-in
+
+    Returns:
+        snapshot (bytes): snapshot of the burned-in model, see CovidSupermarketModel.snapshot()
+
+    """
+    # parameter values may be lists or dicts, which are not hashable
+    cache_key = (json.dumps(params, sort_keys=True), n_burn_in, seed)
+    if cache_key in _snapshots:
+        _snapshots.move_to_end(cache_key)
+        return _snapshots[cache_key]
+
+    model = CovidSupermarketModel(
+        _floorplan, len(_floorplan), len(_floorplan[0]), seed=seed, **params
+    )
+    model.run_model(n_burn_in)
+    _snapshots[cache_key] = model.snapshot()
+    if len(_snapshots) > SNAPSHOT_CACHE_SIZE:
+        _snapshots.popitem(last=False)
+
+    return _snapshots[cache_key]
+
+
+def run_job(job):
+    """Runs a single model in the worker process. A job with a burn-in forks its model from a
+    snapshot of a model that already ran the burn-in with the same parameters, and only runs
+    the remaining steps with its own seed. The collected data still covers all steps, the
+    burn-in steps are shared by all runs forked from the same snapshot
+
+    Args:
+        job (tuple (key, params, n_steps, seed[, burn_in])): identifier of the run, keyword
+            arguments for the model, number of steps to run, seed of the model and optionally
+            the burn-in as a tuple (n_burn_in, burn_in_seed)
+
+    Returns:
+        key: identifier of the run
+        data (pd.DataFrame): model variables collected during the run
+
+    """
+    key, params, n_steps, seed = job[:4]
+    burn_in = job[4] if len(job) > 4 else None
+
+    if burn_in is None:
+        model = CovidSupermarketModel(
+            _floorplan, len(_floorplan), len(_floorplan[0]), seed=seed, **params
+        )
+        model.run_model(n_steps)
+    else:
+        n_burn_in, burn_in_seed = burn_in
+        model = CovidSupermarketModel.from_snapshot(
+            burned_in_snapshot(params, n_burn_in, burn_in_seed), seed
+        )
+        model.run_model(n_steps - n_burn_in)
+
+    return key, model.datacollector.get_model_vars_dataframe()
+
+
+def run_ensemble(jobs, floorplan_path, n_workers=None, chunksize=1):
+    """Runs jobs in a pool of worker processes and yields the results as soon as they complete,
+    so in arbitrary order. Every job carries its own seed, so the results do not depend on the
+    number of workers
+
+    Args:
+        jobs (list of tuples (key, params, n_steps, seed[, burn_in])): runs to execute, see
+            run_job()
+        floorplan_path (string): csv file containing layout of supermarket
+        n_workers (int, optional): number of worker processes, defaults to the number of cores.
+            With 1 worker the jobs are run in the current process
+        chunksize (int): number of consecutive jobs sent to a worker at once. Use the number of
+            replicates per burn-in, so all replicates forked from a burn-in run in one worker
+
+    Yields:
+        key: identifier of the run
+        data (pd.DataFrame): model variables collected during the run
+
+    """
+    if n_workers == 1:
+        init_worker(floorplan_path)
+        for job in jobs:
+            yield run_job(job)
+        return
+
+    with multiprocessing.Pool(n_workers, init_worker, (floorplan_path,)) as pool:
+        for result in pool.imap_unordered(run_job, jobs, chunksize):
+            yield result
@@ -0,0 +1,284 @@
+from collections import deque
+import hashlib
+import os
+import tempfile
+import numpy as np
+
+import core
+
+
+# compiled floorplans of this process, by key
+_cache = {}
+
+
+class Floorplan:
+    """Compiled layout of a supermarket. Holds everything the model derives from the floorplan,
+    so it only has to be computed once per layout. Can be indexed like the 2D list returned by
+    core.load_floorplan, i.e. floorplan[x][y]
+
+    Args:
+        values (2D np array of int): grid with corresponding values of input map
+        shelf_access (list): (shelf type, x, y) of every accessible cell next to a shelf, in the
+            order they were found
+        coord_start_area (list): cells in which customers enter the supermarket
+        inaccessible_cells (list): shelf cells (x, y) without an accessible cell next to them
+        unreachable_shelves (list): shelf types without accessible cells that can be reached
+            from the start area
+        key (string): hash of the input map and thresholds this floorplan was compiled from
+
+    Attributes:
+        values (2D np array of int): grid with corresponding values of input map
+        width (int): width of grid
+        height (int): height of grid
+        walkable (2D np array of bool): true for every cell without an obstacle
+        shelf_access (list): (shelf type, x, y) of every accessible cell next to a shelf
+        coord_shelf (dict {int: set}): accessible cells next to each shelf type
+        access_cells (dict {int: list}): accessible cells next to each shelf type, in the order
+            of the sets in coord_shelf
+        shelf_types (list): all shelf types, in the order of coord_shelf
+        coord_start_area (list): cells in which customers enter the supermarket
+        inaccessible_cells (list): shelf cells (x, y) without an accessible cell next to them
+        unreachable_shelves (list): shelf types without accessible cells that can be reached
+            from the start area
+        key (string): hash of the input map and thresholds this floorplan was compiled from
+
+    """
+    SHELF_THRESHOLD = 100   # special value for which there is difference between shelf and area
+    START_AREA = 101        # grid cell value of the area where customers enter
+    FORMAT_VERSION = 1      # increase whenever from_grid or save change what a compiled file holds
+
+    def __init__(
+        self, values, shelf_access, coord_start_area, inaccessible_cells, unreachable_shelves, key
+    ):
+        self.values = values
+        self.width, self.height = values.shape
+        self.walkable = values > self.SHELF_THRESHOLD
+        self.shelf_access = shelf_access
+
+        # adding the cells in the same order always gives the same iteration order of the sets
+        self.coord_shelf = {}
+        for shelf, x, y in shelf_access:
+            self.coord_shelf.setdefault(shelf, set()).add((x, y))
+        self.access_cells = {shelf: list(cells) for shelf, cells in self.coord_shelf.items()}
+        self.shelf_types = list(self.coord_shelf)
+        self.coord_start_area = coord_start_area
+        self.inaccessible_cells = inaccessible_cells
+        self.unreachable_shelves = unreachable_shelves
+        self.key = key
+
+    def __getitem__(self, index):
+        return self.values[index]
+
+    def __len__(self):
+        return self.width
+
+    def save(self, path):
+        """Saves the compiled floorplan
+
+        Args:
+            path (string or file): npz file to save to
+
+        """
+        np.savez(
+            path, values=self.values,
+            shelf_access=np.array(self.shelf_access, dtype=int).reshape(-1, 3),
+            coord_start_area=np.array(self.coord_start_area, dtype=int).reshape(-1, 2),
+            inaccessible_cells=np.array(self.inaccessible_cells, dtype=int).reshape(-1, 2),
+            unreachable_shelves=np.array(self.unreachable_shelves, dtype=int), key=self.key
+        )
+
+    @classmethod
+    def from_file(cls, path):
+        """Loads a compiled floorplan saved by save()
+
+        Args:
+            path (string): npz file to load
+
+        Returns:
+            floorplan (Floorplan): compiled floorplan
+
+        """
+        with np.load(path) as data:
+            return cls(
+                data["values"], list(map(tuple, data["shelf_access"].tolist())),
+                list(map(tuple, data["coord_start_area"].tolist())),
+                list(map(tuple, data["inaccessible_cells"].tolist())),
+                data["unreachable_shelves"].tolist(), str(data["key"])
+            )
+
+    @classmethod
+    def from_grid(cls, grid, key=None):
+        """Compiles a floorplan
+
+        Args:
+            grid (2D list): grid with corresponding values of input map, see core.load_floorplan
+            key (string, optional): hash of the input map, computed from grid if not given
+
+        Returns:
+            floorplan (Floorplan): compiled floorplan
+
+        """
+        if key is None:
+            key = grid_key(grid)
+        values = np.array([[int(value) for value in column] for column in grid], dtype=int)
+        width, height = values.shape
+        grid = values.tolist()
+
+        # adjacency matrix
+        adjacency = [(i, j) for i in (-1, 0, 1) for j in (-1, 0, 1) if not (i == j == 0)]
+
+        # get the coordinates of all the shelves,
+        # and the coordinates of accesible spaces around them to a dict
+        shelf_access = []
+        found = set()
+        coord_start_area = []
+        inaccessible_cells = []
+        for i in range(width):
+            for j in range(height):
+                shelf_val = grid[i][j]
+                if shelf_val < cls.SHELF_THRESHOLD:
+                    free_space = False
+                    for cor in adjacency:
+                        if grid[i + cor[0]][j + cor[1]] > cls.SHELF_THRESHOLD:
+                            if (shelf_val, i + cor[0], j + cor[1]) not in found:
+                                found.add((shelf_val, i + cor[0], j + cor[1]))
+                                shelf_access.append((shelf_val, i + cor[0], j + cor[1]))
+                            free_space = True
+                    if not free_space:
+                        inaccessible_cells.append((i, j))
+
+                if shelf_val == cls.START_AREA:
+                    coord_start_area.append((i, j))
+
+        # find the shelves that can not be reached from the start area
+        reachable = _reachable(coord_start_area, values > cls.SHELF_THRESHOLD)
+        reachable_shelves = {shelf for shelf, x, y in shelf_access if reachable[x, y]}
+        unreachable_shelves = []
+        for shelf, x, y in shelf_access:
+            if shelf not in reachable_shelves and shelf not in unreachable_shelves:
+                unreachable_shelves.append(shelf)
+
+        return cls(
+            values, shelf_access, coord_start_area, inaccessible_cells, unreachable_shelves, key
+        )
+
+    def report(self):
+        """Prints the problems found in the floorplan while compiling """
+        for i, j in self.inaccessible_cells:
+            print("Error unaccesible shelf cell! ", i, j, self.values[i, j])
+        for shelf in self.unreachable_shelves:
+            print("Error shelf {} can not be reached from the start area!".format(shelf))
+
+
+def grid_key(grid):
+    """Hash of the values of a floorplan grid and the thresholds used to compile it
+
+    Args:
+        grid (2D list): grid with corresponding values of input map
+
+    Returns:
+        key (string): hash of grid
+
+    """
+    text = "\n".join(",".join(str(value) for value in column) for column in grid)
+    text += "\n{},{},{}".format(
+        Floorplan.SHELF_THRESHOLD, Floorplan.START_AREA, Floorplan.FORMAT_VERSION
+    )
+    return hashlib.sha1(text.encode()).hexdigest()
+
+
+def compile_floorplan(grid):
+    """Returns the compiled floorplan of a grid, compiling it only if it was not compiled by this
+    process before
+
+    Args:
+        grid (2D list): grid with corresponding values of input map, see core.load_floorplan
+
+    Returns:
+        floorplan (Floorplan): compiled floorplan
+
+    """
+    key = grid_key(grid)
+    if key not in _cache:
+        _cache[key] = Floorplan.from_grid(grid, key)
+        _cache[key].report()
+
+    return _cache[key]
+
+
+def load(map, cache_dir=None):
+    """Loads the compiled floorplan of a supermarket layout specified in map. The compiled
+    floorplan is kept in memory and in cache_dir, keyed by a hash of the csv file and the format
+    version of compiled floorplans, so every layout is only compiled once
+
+    Args:
+        map (csv): csv file containing layout of supermarket
+        cache_dir (string, optional): directory of compiled floorplans, defaults to the directory
+            .cache next to map
+
+    Returns:
+        floorplan (Floorplan): compiled floorplan
+
+    """
+    with open(map, "rb") as file:
+        key = hashlib.sha1(file.read()).hexdigest()
+    key = hashlib.sha1("{},{},{},{}".format(
+        key, Floorplan.SHELF_THRESHOLD, Floorplan.START_AREA, Floorplan.FORMAT_VERSION).encode()
+    ).hexdigest()
+    if key in _cache:
+        return _cache[key]
+
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(map), ".cache")
+    path = os.path.join(cache_dir, key + ".npz")
+
+    if os.path.exists(path):
+        floorplan = Floorplan.from_file(path)
+    else:
+        floorplan = Floorplan.from_grid(core.load_floorplan(map), key)
+        floorplan.report()
+        os.makedirs(cache_dir, exist_ok=True)
+
+        # save to a temporary file first, so processes loading the same layout never read a
+        # partially written file
+        handle, temp_path = tempfile.mkstemp(suffix=".npz", dir=cache_dir)
+        try:
+            with os.fdopen(handle, "wb") as file:
+                floorplan.save(file)
+            os.replace(temp_path, path)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+
+    _cache[key] = floorplan
+    return floorplan
+
+
+def _reachable(starts, walkable):
+    """Finds all cells that can be reached from any of the start cells
+
+    Args:
+        starts (list): start cells
+        walkable (2D np array of bool): true for every cell without an obstacle
+
+    Returns:
+        reachable (2D np array of bool): true for every cell that can be reached
+
+    """
+    width, height = walkable.shape
+    reachable = np.zeros((width, height), dtype=bool)
+    queue = deque()
+    for start in starts:
+        if walkable[start] and not reachable[start]:
+            reachable[start] = True
+            queue.append(start)
+
+    while queue:
+        x, y = queue.popleft()
+        for dx, dy in ((0, -1), (-1, 0), (1, 0), (0, 1)):
+            nx, ny = x + dx, y + dy
+            if 0 <= nx < width and 0 <= ny < height and walkable[nx, ny] and not reachable[nx, ny]:
+                reachable[nx, ny] = True
+                queue.append((nx, ny))
+
+    return reachable
@@ -0,0 +1,273 @@
+from collections import deque
+import heapq
+import numpy as np
+import random
+import time
+
+from core import get_distance
+import route
+
+
+class AbstractGraph:
+    """Abstract graph of a floorplan for hierarchical path finding (HPA*, Botea et al., 2004).
+    The grid is split in square clusters. Where two clusters share a border, the walkable cells
+    on both sides form entrances, and the cells of each entrance become nodes of the graph. Nodes
+    in the same cluster are connected by the length of the shortest path between them inside the
+    cluster, nodes on both sides of an entrance by a single step. Obstacles never move, so the
+    graph is built once per floorplan
+
+    Args:
+        walkable (2D np array of bool): true for every cell agents are allowed to step on
+        cluster_size (int): width and height of a cluster in grid cells
+
+    Attributes:
+        walkable (2D np array of bool): true for every cell agents are allowed to step on
+        cluster_size (int): width and height of a cluster in grid cells
+        width (int): width of grid
+        height (int): height of grid
+        edges (dict {node: dict {node: int}}): cost of the edges from each node
+        cluster_nodes (dict {cluster: list}): nodes per cluster
+
+    """
+    # entrances of at least this many cells get a node at both ends instead of in the middle
+    LONG_ENTRANCE = 6
+
+    def __init__(self, walkable, cluster_size=10):
+        self.walkable = walkable
+        self.cluster_size = cluster_size
+        self.width, self.height = walkable.shape
+        self.edges = {}
+        self.cluster_nodes = {}
+
+        self._build_entrances()
+        for nodes in self.cluster_nodes.values():
+            for node in nodes:
+                distances, _ = self._search_cluster(node)
+                for other in nodes:
+                    if other != node and other in distances:
+                        self.edges[node][other] = distances[other]
+
+    def cluster(self, pos):
+        """Returns the cluster (column, row) of a grid cell """
+        return pos[0] // self.cluster_size, pos[1] // self.cluster_size
+
+    def _add_node(self, pos):
+        if pos not in self.edges:
+            self.edges[pos] = {}
+            self.cluster_nodes.setdefault(self.cluster(pos), []).append(pos)
+
+    def _add_entrance(self, run):
+        """Adds the nodes of an entrance, given as the pairs of cells on both sides of it """
+        if len(run) < self.LONG_ENTRANCE:
+            pairs = [run[len(run) // 2]]
+        else:
+            pairs = [run[0], run[-1]]
+
+        for cell, other in pairs:
+            self._add_node(cell)
+            self._add_node(other)
+            self.edges[cell][other] = 1
+            self.edges[other][cell] = 1
+
+    def _build_entrances(self):
+        """Finds the entrances on all borders between clusters """
+        size = self.cluster_size
+        walkable = self.walkable
+
+        # vertical borders, between cells (x, y) and (x + 1, y)
+        for x in range(size - 1, self.width - 1, size):
+            run = []
+            for y in range(self.height):
+                if walkable[x, y] and walkable[x + 1, y] and (not run or y % size):
+                    run.append(((x, y), (x + 1, y)))
+                    continue
+                if run:
+                    self._add_entrance(run)
+                run = [((x, y), (x + 1, y))] if walkable[x, y] and walkable[x + 1, y] else []
+            if run:
+                self._add_entrance(run)
+
+        # horizontal borders, between cells (x, y) and (x, y + 1)
+        for y in range(size - 1, self.height - 1, size):
+            run = []
+            for x in range(self.width):
+                if walkable[x, y] and walkable[x, y + 1] and (not run or x % size):
+                    run.append(((x, y), (x, y + 1)))
+                    continue
+                if run:
+                    self._add_entrance(run)
+                run = [((x, y), (x, y + 1))] if walkable[x, y] and walkable[x, y + 1] else []
+            if run:
+                self._add_entrance(run)
+
+    def _search_cluster(self, source, target=None):
+        """Breadth-first search from source over the walkable cells of its cluster
+
+        Args:
+            source (x, y): start cell
+            target (x, y, optional): stop as soon as this cell is reached
+
+        Returns:
+            distances (dict {pos: int}): number of steps from source to each reached cell
+            parents (dict {pos: pos}): previous cell on the shortest path to each reached cell
+
+        """
+        cluster = self.cluster(source)
+        distances = {source: 0}
+        parents = {source: None}
+        queue = deque([source])
+        while queue:
+            pos = queue.popleft()
+            if pos == target:
+                break
+            for dx, dy in route.NEIGHBOUR_OFFSETS:
+                cell = (pos[0] + dx, pos[1] + dy)
+                if cell not in distances and 0 <= cell[0] < self.width \
+                        and 0 <= cell[1] < self.height and self.walkable[cell] \
+                        and self.cluster(cell) == cluster:
+                    distances[cell] = distances[pos] + 1
+                    parents[cell] = pos
+                    queue.append(cell)
+
+        return distances, parents
+
+    def find_abstract_path(self, start, goal):
+        """Searches the abstract graph with A*. Start and goal are connected to the nodes of their
+        clusters first, and to each other if they are in the same cluster
+
+        Args:
+            start (x, y): start coordinates
+            goal (x, y): goal coordinates
+
+        Returns:
+            nodes (list): nodes from start to goal (both included), None if goal is unreachable
+            length (int): length of the path, None if goal is unreachable
+            expansions (int): number of nodes expanded, including the cells of the searches that
+                connect start and goal
+
+        """
+        if start == goal:
+            return [start], 0, 0
+
+        # connect start and goal to the graph without changing it
+        start_distances, _ = self._search_cluster(start)
+        goal_distances, _ = self._search_cluster(goal)
+        expansions = len(start_distances) + len(goal_distances)
+        start_edges = {
+            node: start_distances[node] for node in self.cluster_nodes.get(self.cluster(start), [])
+            if node in start_distances
+        }
+        if goal in start_distances:
+            start_edges[goal] = start_distances[goal]
+        goal_edges = {
+            node: goal_distances[node] for node in self.cluster_nodes.get(self.cluster(goal), [])
+            if node in goal_distances
+        }
+
+        g_scores = {start: 0}
+        parents = {start: None}
+        closed = set()
+        unexplored = [(get_distance(start, goal), 0, start)]
+        while unexplored:
+            _, g_score, node = heapq.heappop(unexplored)
+            if node in closed:
+                continue
+            closed.add(node)
+            expansions += 1
+
+            if node == goal:
+                nodes = []
+                while node is not None:
+                    nodes.append(node)
+                    node = parents[node]
+                nodes.reverse()
+                return nodes, g_score, expansions
+
+            edges = self.edges.get(node, {})
+            if node == start:
+                edges = dict(edges)
+                edges.update(start_edges)
+            if node in goal_edges:
+                edges = dict(edges)
+                edges[goal] = goal_edges[node]
+            for neighbour, cost in edges.items():
+                tentative_g_score = g_score + cost
+                if neighbour not in closed and tentative_g_score < g_scores.get(neighbour, np.inf):
+                    g_scores[neighbour] = tentative_g_score
+                    parents[neighbour] = node
+                    heapq.heappush(unexplored, (
+                        tentative_g_score + get_distance(neighbour, goal), tentative_g_score,
+                        neighbour
+                    ))
+
+        return None, None, expansions
+
+    def refine(self, pos, node):
+        """Returns the grid cells of an edge of the abstract graph
+
+        Args:
+            pos (x, y): first node of the edge
+            node (x, y): second node of the edge
+
+        Returns:
+            cells (list): cells from pos (excluded) to node (included)
+            expansions (int): number of cells expanded
+
+        """
+        if self.cluster(pos) != self.cluster(node):
+            return [node], 0
+
+        distances, parents = self._search_cluster(pos, node)
+        cells = []
+        while node != pos:
+            cells.append(node)
+            node = parents[node]
+        cells.reverse()
+
+        return cells, len(distances)
+
+
+def compare_with_flat(model, n_queries=100, seed=0):
+    """Compares the hierarchical planner with the flat A* (method "heap") of the model on random
+    pairs of walkable cells that are connected
+
+    Args:
+        model (CovidSupermarketModel): model to plan routes in
+        n_queries (int): number of start and goal pairs
+        seed (int): seed for drawing the pairs
+
+    Returns:
+        comparison (dict): number of queries, mean and maximum ratio between the length of the
+            hierarchical and the flat path, and total expansions and time of both planners
+
+    """
+    rng = random.Random(seed)
+    graph = model.get_abstract_graph()
+    cells = [tuple(cell) for cell in zip(*model.grid.walkable.nonzero())]
+    comparison = {
+        "queries": 0, "mean_ratio": 0.0, "max_ratio": 1.0, "flat_expansions": 0,
+        "hierarchical_expansions": 0, "flat_time": 0.0, "hierarchical_time": 0.0
+    }
+
+    while comparison["queries"] < n_queries:
+        start, goal = rng.choice(cells), rng.choice(cells)
+        if start == goal or model.get_flow_field(goal)[start] < 0:
+            continue
+
+        time_start = time.time()
+        flat = route.Route(model, start, goal, model.grid, method="heap")
+        comparison["flat_time"] += time.time() - time_start
+
+        time_start = time.time()
+        hierarchical = route.Route(model, start, goal, model.grid, method="hpa")
+        comparison["hierarchical_time"] += time.time() - time_start
+
+        ratio = hierarchical.path_length / flat.path_length
+        comparison["queries"] += 1
+        comparison["mean_ratio"] += ratio
+        comparison["max_ratio"] = max(comparison["max_ratio"], ratio)
+        comparison["flat_expansions"] += flat.expansions
+        comparison["hierarchical_expansions"] += hierarchical.expansions
+
+    comparison["mean_ratio"] /= max(comparison["queries"], 1)
+    return comparison
@@ -1,13 +1,20 @@
+from functools import partial
 import numpy as np
+import pickle
+import random
 import time
-import copy
 from mesa import Model
 from mesa.space import MultiGrid
 from mesa.time import RandomActivation
-from mesa.datacollection import DataCollector
 
 import core
-from agent import Customer, Obstacle
+import hierarchy
+import route
+from agent import ArrayCustomer, Customer, Obstacle
+from floorplan import Floorplan, compile_floorplan
+from population import Population
+from recorder import MetricRecorder
+from scheduler import ArrayActivation
 from space import SuperMarketGrid
 
 
@@ -15,7 +22,8 @@ class CovidSupermarketModel(Model):
     """Model of agents (Customers) in a supermarket
 
     Args:
-        floorplan (2D list): grid with corresponding values of input map from supermarket
+        floorplan (Floorplan or 2D list): (compiled) grid with corresponding values of input map
+            from supermarket, see floorplan.load
         width (int): width of grid
         height (int): height of grid
         N_customers (int <- min. 0): total number of customers
@@ -23,9 +31,23 @@ class CovidSupermarketModel(Model):
         len_shoplist (int <- min. 0): amount of items to place on shopping list
         basic_compliance (float <- [0, 1]): basic level of compliance, higher is more compliant
         vision (int <- min. 3): amount of grid cells customer can see other customers
+        route_method (string: ("astar", "heap", "flowfield", "dstar", "hpa")): path finding method
+            of the customers
+        route_cache_size (int <- min. 0): number of paths kept in the route cache, 0 disables it.
+            A cached path skips the random tie breaks of its search, so seeded runs with and
+            without cache differ
+        population_store (boolean): keep the state of the customers in a struct-of-arrays
+            population store, for large numbers of customers
+        scheduler (string: ("random", "array")): activation scheduler, the mesa RandomActivation
+            or the array backed ArrayActivation. Both activate customers in random order, but
+            seeded runs give different orders
+        instrument (boolean): record the wall time per phase and the path finding counters of
+            every step in telemetry
+        seed (int, optional): seed of the random number generator of the model
 
     Attributes:
-        floorplan (2D list): grid with corresponding values of input map from supermarket
+        floorplan (Floorplan): compiled grid with corresponding values of input map from
+            supermarket
         width (int): width of grid
         height (int): height of grid
         N_customers (int <- min. 0): total number of customers
@@ -33,28 +55,56 @@ class CovidSupermarketModel(Model):
         len_shoplist (int <- min. 0): amount of items to place on shopping list
         basic_compliance (float <- [0, 1]): basic level of compliance, higher is more compliant
         vision (int <- min. 3): amount of grid cells customer can see other customers
+        abstract_graph (hierarchy.AbstractGraph): graph for hierarchical path finding, built on
+            first use
         agents_to_remove (list): agents that will be removed after a single simulation step
-        datacollector: DataCollector object to collect data for analyzing simulation
+        datacollector: MetricRecorder object to collect data for analyzing simulation
+        flow_fields (dict {pos: 2D np array}): cached distance field per goal cell
+        obstacles (dict {pos: Obstacle}): Obstacle objects created so far, for visualization
+        population (Population): state of the customers if the population store is used, else
+            None
         grid: grid of environment
-        heatgrid: grid of environment for heat map
+        heatgrid (2D np array of float): accumulated problematic contacts per cell, for heat map
         n_problematic_contacts (int): number of contacts violating distant rules
         running (boolean): if true keeps the simulation running
+        route_method (string: ("astar", "heap", "flowfield", "dstar", "hpa")): path finding method
+            of the customers
+        route_cache (route.RouteCache): recently found paths, shared by all customers
         schedule: schedule for updating model to next time frame
+        step_stats (dict {name: number}): wall time per phase (time_<phase>) and path finding
+            counters of the current step if instrumented, else None
+        telemetry (MetricRecorder): step_stats of every step if instrumented, else None. Like
+            the datacollector its first row is the initial state, i.e. all zeros, and row i
+            belongs to step i
 
     """
     description = "Supermarket Covid Model.\
     Agent color represents its status: vaccinated (green), problematic contact (red), else (blue).\
     "
-    SHELF_THRESHOLD = 100   # special value for which there is difference between shelf and area
+    SHELF_THRESHOLD = Floorplan.SHELF_THRESHOLD
     AVOID_RADIUS = 3        # 3 corresponds to a distance keeping of 1.5 meter
+    CLUSTER_SIZE = 10       # size of the clusters of the hierarchical path finding
+
+    # phases of a step and path finding counters recorded by the telemetry
+    TELEMETRY_PHASES = ["spawn", "schedule", "removal", "contacts", "collect"]
+    TELEMETRY_COUNTERS = [
+        "routes", "route_cache_hits", "expansions", "alternative_routes", "route_swaps"
+    ]
 
     def __init__(
         self, floorplan, width, height, N_customers=100, vaccination_prop=0.2, len_shoplist=10,
-        basic_compliance=0.2, vision=3
+        basic_compliance=0.2, vision=3, route_method="astar", route_cache_size=0,
+        population_store=False, scheduler="random", instrument=False, seed=None
     ):
         super().__init__()
 
-        # init basic properties
+        # mesa stores the generator on the class, give each model its own (equally seeded) one
+        self._seed = seed
+        self.random = random.Random(seed)
+
+        # init basic properties, the floorplan is only compiled if this was not done before
+        if not isinstance(floorplan, Floorplan):
+            floorplan = compile_floorplan(floorplan)
         self.floorplan = floorplan
         self.width = width
         self.height = height
@@ -63,50 +113,45 @@ class CovidSupermarketModel(Model):
         self.len_shoplist = len_shoplist
         self.basic_compliance = basic_compliance
         self.vision = vision
+        self.route_method = route_method
+        self.route_cache = route.RouteCache(route_cache_size)
 
         self.agents_to_remove = []
         self.customers = []
-        self.coord_shelf = {}
-        self.coord_start_area = []
+        self._customer_index = {}
+        self.coord_shelf = self.floorplan.coord_shelf
+        self.coord_start_area = self.floorplan.coord_start_area
         self.exit_list = []
+        self.flow_fields = {}
+        self.abstract_graph = None
+        self.obstacles = {}
+        self.population = Population(len_shoplist + 1, N_customers) if population_store else None
 
-        self.schedule = RandomActivation(self)
+        if scheduler == "array":
+            self.schedule = ArrayActivation(self)
+        else:
+            self.schedule = RandomActivation(self)
         self.running = True     # needed to keep simulation running
 
         self.grid = SuperMarketGrid(self.width, self.height, self.AVOID_RADIUS)
 
         # add obstacles to grid
-        for i in range(self.width):
-            for j in range(self.height):
-                if int(self.floorplan[i][j]) <= self.SHELF_THRESHOLD:
-                    self.new_obstacle((i, j), self.floorplan[i][j])
-
-        # adjacency matrix
-        adjacency = [(i, j) for i in (-1, 0, 1) for j in (-1, 0, 1) if not (i == j == 0)]
-
-        # get the coordinates of all the shelves,
-        # and the coordinates of accesible spaces around them to a dict
-        for i in range(self.width):
-            for j in range(self.height):
-                shelf_val = int(self.floorplan[i][j])
-                if shelf_val < self.SHELF_THRESHOLD:
-                    free_space = False
-                    for cor in adjacency:
-                        if int(self.floorplan[i + cor[0]][j + cor[1]]) > self.SHELF_THRESHOLD:
-                            if shelf_val in self.coord_shelf.keys():
-                                self.coord_shelf[shelf_val].add((i + cor[0], j + cor[1]))
-                            else:
-                                self.coord_shelf.update({shelf_val: {(i + cor[0], j + cor[1])}})
-
-                            free_space = True
-                    if not free_space:
-                        print("Error unaccesible shelf cell! ", i, j, self.floorplan[i][j])
-
-                if shelf_val == 101:
-                    self.coord_start_area.append((i, j))
+        self.grid.set_obstacles(self.floorplan.values, self.floorplan.walkable)
+        self.grid.set_entrance(self.coord_start_area)
 
         # use heatgrid
-        self.heatgrid = copy.deepcopy(self.grid)
+        self.heatgrid = np.zeros((self.width, self.height))
+
+        # instrumentation, counters are only updated if step_stats is not None
+        self.step_stats = None
+        self.telemetry = None
+        if instrument:
+            names = ["time_" + name for name in self.TELEMETRY_PHASES] + self.TELEMETRY_COUNTERS
+            self.step_stats = dict.fromkeys(names, 0)
+            self.telemetry = MetricRecorder(
+                model_reporters={name: partial(_step_stat, name=name) for name in names},
+                dtypes={name: np.int64 for name in self.TELEMETRY_COUNTERS}
+            )
 
         # start adding customers
         for _ in range(N_customers):
@@ -117,12 +162,17 @@ class CovidSupermarketModel(Model):
         self.problematic_contacts()
 
         # datacollection
-        self.datacollector = DataCollector(
+        self.datacollector = MetricRecorder(
             model_reporters={"n_problematic_contacts": "n_problematic_contacts"},
-            agent_reporters={}
+            dtypes={"n_problematic_contacts": np.int64}
         )
         self.datacollector.collect(self)
 
+        # record an initial row of zeros, so the rows of telemetry line up with the datacollector
+        if self.telemetry is not None:
+            self.step_stats = dict.fromkeys(self.step_stats, 0)
+            self.telemetry.collect(self)
+
     def is_occupied(self, pos):
         """Check if a cell or region around a cell is occupied (pos)
 
@@ -130,8 +180,10 @@ class CovidSupermarketModel(Model):
             pos (x, y): positon of agent on grid
 
         Returns:
-            Boolean: true if occupied, else false
+            Boolean: true if occupied (by an agent or obstacle), else false
         """
+        if not self.grid.walkable[pos]:
+            return True
         cell = self.grid.get_cell_list_contents([pos])
         return len(cell) > 0
 
@@ -150,7 +202,9 @@ class CovidSupermarketModel(Model):
         neighborhood = self.grid.get_neighborhood(pos, moore, radius=radius)
         neighbors_pos = [x.pos for x in self.grid.get_neighbors(pos, moore, radius=radius)]
 
-        return list([x for x in neighborhood if x not in neighbors_pos])
+        return list([
+            x for x in neighborhood if self.grid.walkable[x] and x not in neighbors_pos
+        ])
 
     def add_customer(self, pos):
         """Adds a new agent to a random location on the grid. Returns the created agent
@@ -165,43 +219,152 @@ class CovidSupermarketModel(Model):
         else:
             vaccinated = False
 
-        new_agent = Customer(
+        customer_type = ArrayCustomer if self.population is not None else Customer
+        new_agent = customer_type(
             self.next_id(), self, pos, self.AVOID_RADIUS, self.basic_compliance, self.len_shoplist,
             self.random.random(), self.random.random(), vaccinated, vision=self.vision
         )
         self.grid.place_agent(new_agent, pos)
         self.schedule.add(new_agent)
+        self._customer_index[new_agent] = len(self.customers)
         self.customers.append(new_agent)
 
+    def remove_customer(self, agent):
+        """Removes a customer from the grid, the schedule and the list of customers. The last
+        customer in the list takes the place of the removed one, so the order of the list changes
+
+        Args:
+            agent (Customer): customer to remove
+
+        """
+        self.grid.remove_agent(agent)
+        self.schedule.remove(agent)
+
+        index = self._customer_index.pop(agent)
+        last = self.customers.pop()
+        if last is not agent:
+            self.customers[index] = last
+            self._customer_index[last] = index
+
+        if self.population is not None:
+            self.population.remove(agent.row)
+
     def get_entrance_pos(self):
         "Check if there is a free pos the agent can enter the store in when a place frees up"
-        free_pos = []
-        for pos in self.coord_start_area:
-            if not self.is_occupied(pos):
-                free_pos.append(pos)
-        if free_pos:
-            return self.random.choice(free_pos)
+        return self.grid.free_entrance.sample(self.random)
+
+    def get_flow_field(self, goal):
+        """Returns the distance field towards goal. Fields are computed on first use and cached,
+        because the obstacles never move
+
+        Args:
+            goal (x, y): goal coordinates
+
+        Returns:
+            field (2D np array of int): number of steps to goal per cell, -1 if unreachable
+
+        """
+        if goal not in self.flow_fields:
+            self.flow_fields[goal] = route.distance_field(goal, self.grid.walkable)
 
-        return None
+        return self.flow_fields[goal]
 
-    def new_obstacle(self, pos, type_id):
-        """Adds a new agent as obstacle to a random location on the grid
+    def get_abstract_graph(self):
+        """Returns the abstract graph of the floorplan for hierarchical path finding. The graph
+        is built on first use, because the obstacles never move
+
+        Returns:
+            graph (hierarchy.AbstractGraph): abstract graph of the floorplan
+
+        """
+        if self.abstract_graph is None:
+            self.abstract_graph = hierarchy.AbstractGraph(self.grid.walkable, self.CLUSTER_SIZE)
+
+        return self.abstract_graph
+
+    def get_obstacle(self, pos):
+        """Returns the obstacle on a position. Obstacles are stored in the obstacle layer of the
+        grid, Obstacle objects are only created (once) when they are asked for, e.g. to draw them
 
         Args:
-            pos (x, y): positon of agent on grid
-            type_id (int): shelf id for obstacle
+            pos (x, y): positon of obstacle on grid
 
         Returns:
-            new_agent (Obstacle): newly created Obstacle object
+            obstacle (Obstacle): Obstacle object on pos, None if pos is walkable
         """
-        new_agent = Obstacle(self.next_id(), type_id, self, pos)
-        self.grid.place_agent(new_agent, pos)
+        if self.grid.walkable[pos]:
+            return None
+        if pos not in self.obstacles:
+            self.obstacles[pos] = Obstacle(self.next_id(), int(self.grid.shelf_id[pos]), self, pos)
 
-        return new_agent
+        return self.obstacles[pos]
 
     def problematic_contacts(self):
-        """Calculates the total amount of problematic contacts """
+        """Calculates the total amount of problematic contacts. Candidate pairs are found by
+        sorting the unvaccinated customers on their x coordinate, after which distances and
+        barriers (from the barrier mask of the grid) are checked for all pairs at once. Gives the
+        same result as problematic_contacts_loop()
+        """
+        radius = self.AVOID_RADIUS
 
+        # reset variables
+        self.n_problematic_contacts = 0
+        if self.population is not None:
+            population = self.population
+            population.is_problematic_contact[:] = False
+
+            # if one of the agents is vaccinated, do not count as a contact
+            rows = np.flatnonzero(population.active & ~population.vaccinated)
+            if len(rows) < 2:
+                return
+            pos = population.pos[rows]
+        else:
+            for customer in self.customers:
+                customer.is_problematic_contact = False
+
+            # if one of the agents is vaccinated, do not count as a contact
+            customers = [customer for customer in self.customers if not customer.vaccinated]
+            if len(customers) < 2:
+                return
+            pos = np.array([customer.pos for customer in customers])
+        order = np.argsort(pos[:, 0], kind="stable")
+        pos = pos[order]
+
+        # for every customer, the range of sorted customers within radius in x direction
+        lower = np.searchsorted(pos[:, 0], pos[:, 0] - radius, side="left")
+        upper = np.searchsorted(pos[:, 0], pos[:, 0] + radius, side="right")
+        counts = upper - lower
+        first = np.repeat(np.arange(len(pos)), counts)
+        second = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) \
+            + lower[first]
+
+        # keep pairs of different customers within radius that are not shielded by an obstacle
+        delta = pos[second] - pos[first]
+        contact = (first != second) & (np.abs(delta).sum(axis=1) <= radius)
+        first, second, delta = first[contact], second[contact], delta[contact]
+        shielded = self.grid.is_shielded(
+            (pos[first, 0], pos[first, 1]), (delta[:, 0], delta[:, 1])
+        )
+        second = second[~shielded]
+        if not len(second):
+            return
+
+        # every customer that is seen by another customer is in a problematic contact
+        if self.population is not None:
+            population.is_problematic_contact[rows[order[second]]] = True
+        else:
+            for index in np.unique(second):
+                customers[order[index]].is_problematic_contact = True
+
+        np.add.at(self.heatgrid, (pos[second, 0], pos[second, 1]), 0.5)
+
+        # divide by 2, because we count contacts double
+        self.n_problematic_contacts = int(len(second) / 2)
+
+    def problematic_contacts_loop(self):
+        """Calculates the total amount of problematic contacts one customer at a time. Reference
+        implementation of problematic_contacts()
+        """
         # reset variables
         self.n_problematic_contacts = 0
         for customer in self.customers:
@@ -213,10 +376,10 @@ class CovidSupermarketModel(Model):
                 neighbors = self.grid.get_neighbors(
                     customer.pos, moore=False, include_center=True, radius=self.AVOID_RADIUS
                 )
-                safe_pos = self.grid.get_safe_pos(neighbors, customer, customer.pos)
+                safe_pos = self.grid.get_safe_pos(customer.pos)
 
                 for neighbor in neighbors:
-                    if type(neighbor) is Customer:
+                    if isinstance(neighbor, Customer):
                         if neighbor is not customer:
                             if neighbor.pos not in safe_pos:
                                 if not neighbor.vaccinated:
@@ -224,10 +387,7 @@ class CovidSupermarketModel(Model):
 
                                     neighbor.is_problematic_contact = True
 
-                                    if not self.heatgrid[neighbor.pos[0]][neighbor.pos[1]]:
-                                        self.heatgrid[neighbor.pos[0]][neighbor.pos[1]] = 0.5
-                                    else:
-                                        self.heatgrid[neighbor.pos[0]][neighbor.pos[1]] += 0.5
+                                    self.heatgrid[neighbor.pos] += 0.5
 
         # divide by 2, because we count contacts double
         self.n_problematic_contacts = int(self.n_problematic_contacts / 2)
@@ -239,38 +399,105 @@ class CovidSupermarketModel(Model):
             pos (x, y): free positon on grid
 
         """
-        if not self.grid.empties:
+        if not self.grid.free_cells:
             print("Error! No empty cells found! Lower the amount of agents or enlarge the grid")
             exit(-1)
-        x, y = self.random.choice(list(self.grid.empties))
-        if not self.is_occupied((x, y)):
-            return x, y
+        return self.grid.free_cells.sample(self.random)
+
+    def snapshot(self):
+        """Returns a snapshot of the complete state of the model, i.e. positions, shopping lists,
+        routes, scores and the state of the random number generator
+
+        Returns:
+            snapshot (bytes): pickled model
+        """
+        return pickle.dumps(self, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @staticmethod
+    def from_snapshot(snapshot, seed=None):
+        """Restores a model from a snapshot. Give each model restored from the same snapshot its
+        own seed to simulate independent replicates from the state of the snapshot
+
+        Args:
+            snapshot (bytes): snapshot of a model, see snapshot()
+            seed (int, optional): new seed of the random number generator of the model. If not
+                given, the model continues exactly like the model of the snapshot
+
+        Returns:
+            model (CovidSupermarketModel): restored model
+        """
+        model = pickle.loads(snapshot)
+        if seed is not None:
+            model.reset_randomizer(seed)
+
+        return model
+
+    def fork(self, seed=None):
+        """Returns an independent copy of the model, see from_snapshot()
+
+        Args:
+            seed (int, optional): seed of the random number generator of the copy
+
+        Returns:
+            model (CovidSupermarketModel): copy of the model
+        """
+        return self.from_snapshot(self.snapshot(), seed)
 
     def run_model(self, n_steps=200):
         """Run model for n_steps"""
+        self.datacollector.reserve(n_steps)
+        if self.telemetry is not None:
+            self.telemetry.reserve(n_steps)
         for i in range(n_steps):
             self.step()
 
-    def step(self):
-        """Progress simulation by one step """
-        time_start = time.time()
-
-        # let new agents enter if there are less agents than N_customers
+    def spawn_customer(self):
+        """Lets a new agent enter if there are less agents than N_customers """
         if len(self.customers) < self.N_customers:
             new_pos = self.get_entrance_pos()
             if new_pos:
                 self.add_customer(new_pos)
 
-        self.schedule.step()
-
-        # remove agents from environment
+    def remove_customers(self):
+        """Removes the agents that left the supermarket during the step from the environment """
         if self.agents_to_remove:
             for agent in self.agents_to_remove:
-                self.grid.remove_agent(agent)
-                self.schedule.remove(agent)
-                self.customers.remove(agent)
+                self.remove_customer(agent)
             self.agents_to_remove = []
 
+    def step(self):
+        """Progress simulation by one step """
+        if self.telemetry is not None:
+            self.instrumented_step()
+            return
+
+        self.spawn_customer()
+        self.schedule.step()
+        self.remove_customers()
+
         # calculate number of problematic contacts
         self.problematic_contacts()
         self.datacollector.collect(self)
+
+    def instrumented_step(self):
+        """Progress simulation by one step, while recording the wall time of each phase of the
+        step and the path finding counters of the step in telemetry
+        """
+        for name in self.TELEMETRY_COUNTERS:
+            self.step_stats[name] = 0
+
+        phases = [
+            self.spawn_customer, self.schedule.step, self.remove_customers,
+            self.problematic_contacts, lambda: self.datacollector.collect(self)
+        ]
+        for name, phase in zip(self.TELEMETRY_PHASES, phases):
+            time_start = time.perf_counter()
+            phase()
+            self.step_stats["time_" + name] = time.perf_counter() - time_start
+
+        self.telemetry.collect(self)
+
+
+def _step_stat(model, name):
+    """Reporter of a value of the step_stats of a model, for the telemetry """
+    return model.step_stats[name]
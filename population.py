@@ -0,0 +1,167 @@
+import numpy as np
+
+
+class Population:
+    """Struct-of-arrays store of the state of customers. Every customer occupies a row of each
+    array, so bulk operations (e.g. counting problematic contacts) work on whole arrays instead
+    of reading attributes customer by customer. Rows of removed customers are reused, the arrays
+    grow when more customers are added than there is capacity for
+
+    Args:
+        max_items (int): maximum length of a shopping list, including the exit
+        capacity (int): number of customers to reserve space for
+
+    Attributes:
+        max_items (int): maximum length of a shopping list, including the exit
+        active (np array of bool): true for every row that belongs to a customer
+        pos (2D np array of int): position (x, y) per row, (-1, -1) if not on the grid
+        patience (np array of float): patience per row
+        patience_0 (np array of float): patience on t=0 per row
+        basic_compliance (np array of float): basic level of compliance per row
+        personal_compliance (np array of float): personal level of compliance per row
+        vaccinated (np array of bool): if the customer is vaccinated, per row
+        is_problematic_contact (np array of bool): if the customer is in a problematic contact
+        vision (np array of int): vision per row
+        avoid_radius (np array of int): avoid radius per row
+        shop_cells (3D np array of int): cells (x, y) of the shopping list per row, the items
+            of a row are shop_cells[row, shop_first[row]:shop_end[row]]
+        shop_first (np array of int): index of the first item of the shopping list per row
+        shop_end (np array of int): index after the last item of the shopping list per row
+
+    """
+    # name, type and shape per customer of each array
+    FIELDS = [
+        ("active", bool, ()), ("pos", int, (2,)), ("patience", float, ()),
+        ("patience_0", float, ()), ("basic_compliance", float, ()),
+        ("personal_compliance", float, ()), ("vaccinated", bool, ()),
+        ("is_problematic_contact", bool, ()), ("vision", int, ()), ("avoid_radius", int, ()),
+        ("shop_first", int, ()), ("shop_end", int, ())
+    ]
+
+    def __init__(self, max_items, capacity=0):
+        self.max_items = max_items
+        self._free = []
+        self._n_rows = 0
+        for name, dtype, shape in self.FIELDS:
+            setattr(self, name, np.zeros((capacity,) + shape, dtype=dtype))
+        self.shop_cells = np.zeros((capacity, max_items, 2), dtype=int)
+
+    def __len__(self):
+        return self._n_rows - len(self._free)
+
+    @property
+    def rows(self):
+        """Rows of all customers in the store """
+        return np.flatnonzero(self.active)
+
+    def _grow(self, capacity):
+        """Enlarges the arrays to hold capacity customers
+
+        Args:
+            capacity (int): number of customers to make space for
+
+        """
+        for name, dtype, shape in self.FIELDS + [("shop_cells", int, (self.max_items, 2))]:
+            array = getattr(self, name)
+            new_array = np.zeros((capacity,) + shape, dtype=dtype)
+            new_array[:len(array)] = array
+            setattr(self, name, new_array)
+
+    def add(self):
+        """Reserves a row for a new customer
+
+        Returns:
+            row (int): row of the customer
+
+        """
+        if self._free:
+            row = self._free.pop()
+        else:
+            row = self._n_rows
+            self._n_rows += 1
+            if row >= len(self.active):
+                self._grow(max(2 * len(self.active), 16))
+
+        for name, dtype, shape in self.FIELDS:
+            getattr(self, name)[row] = 0
+        self.active[row] = True
+        self.pos[row] = -1
+
+        return row
+
+    def remove(self, row):
+        """Frees the row of a customer that left, so it can be reused
+
+        Args:
+            row (int): row of the customer
+
+        """
+        self.active[row] = False
+        self.is_problematic_contact[row] = False
+        self._free.append(row)
+
+
+class ShoppingList:
+    """List of the cells on the shopping list of a customer in a Population. Supports the list
+    operations customers use: indexing, len, append, pop and index
+
+    Args:
+        population (Population): store of the customer
+        row (int): row of the customer
+
+    """
+    def __init__(self, population, row):
+        self.population = population
+        self.row = row
+
+    def _cells(self):
+        population, row = self.population, self.row
+        return population.shop_cells[row, population.shop_first[row]:population.shop_end[row]]
+
+    def __len__(self):
+        return int(self.population.shop_end[self.row] - self.population.shop_first[self.row])
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [tuple(cell) for cell in self._cells()[index].tolist()]
+        return tuple(self._cells()[index].tolist())
+
+    def __setitem__(self, index, cell):
+        self._cells()[index] = cell
+
+    def __iter__(self):
+        return iter(self[:])
+
+    def __eq__(self, other):
+        return self[:] == list(other)
+
+    def __repr__(self):
+        return repr(self[:])
+
+    def append(self, cell):
+        population, row = self.population, self.row
+
+        # move the items to the front of the row if there is no space left behind them
+        if population.shop_end[row] == population.max_items and population.shop_first[row]:
+            cells = self._cells().copy()
+            population.shop_cells[row, :len(cells)] = cells
+            population.shop_first[row], population.shop_end[row] = 0, len(cells)
+
+        population.shop_cells[row, population.shop_end[row]] = cell
+        population.shop_end[row] += 1
+
+    def index(self, cell):
+        return self[:].index(tuple(cell))
+
+    def pop(self, index=-1):
+        cells = self[:]
+        cell = cells.pop(index)
+        population, row = self.population, self.row
+        if index == 0:
+            population.shop_first[row] += 1
+        else:
+            population.shop_end[row] -= 1
+            if cells:
+                self._cells()[:] = cells
+
+        return cell
@@ -0,0 +1,115 @@
+from collections.abc import Mapping, Sequence
+import numpy as np
+import pandas as pd
+
+
+class MetricRecorder:
+    """Lightweight replacement of the mesa DataCollector for model level metrics. Every metric is
+    recorded in a preallocated typed array, which grows when more steps are recorded than
+    reserved
+
+    Args:
+        model_reporters (dict {name: reporter}): metrics to record, a reporter is either the name
+            of a model attribute or a function that takes the model as argument
+        n_steps (int): number of steps to reserve space for
+        dtypes (dict {name: dtype}, optional): type per metric, float by default
+
+    Attributes:
+        model_reporters (dict {name: reporter}): metrics to record
+        n_records (int): number of recorded steps
+
+    """
+    def __init__(self, model_reporters, n_steps=0, dtypes={}):
+        self.model_reporters = model_reporters
+        self.n_records = 0
+        self._arrays = {
+            name: np.empty(n_steps, dtype=dtypes.get(name, float)) for name in model_reporters
+        }
+
+    def reserve(self, n_steps):
+        """Makes sure there is space for recording n_steps more steps
+
+        Args:
+            n_steps (int): number of steps to reserve space for
+
+        """
+        capacity = self.n_records + n_steps
+        for name, array in self._arrays.items():
+            if len(array) < capacity:
+                new_array = np.empty(max(capacity, 2 * len(array)), dtype=array.dtype)
+                new_array[:self.n_records] = array[:self.n_records]
+                self._arrays[name] = new_array
+
+    def collect(self, model):
+        """Records the current value of each metric of model
+
+        Args:
+            model: model object to record the metrics of
+
+        """
+        self.reserve(1)
+        for name, reporter in self.model_reporters.items():
+            if isinstance(reporter, str):
+                value = getattr(model, reporter)
+            else:
+                value = reporter(model)
+            self._arrays[name][self.n_records] = value
+        self.n_records += 1
+
+    def get(self, name):
+        """Returns the recorded values of a metric
+
+        Args:
+            name (string): name of the metric
+
+        Returns:
+            values (np array): view of the recorded values, valid until the next collect()
+
+        """
+        return self._arrays[name][:self.n_records]
+
+    @property
+    def model_vars(self):
+        """Recorded values per metric, indexable like the lists of the mesa DataCollector """
+        return _ModelVars(self)
+
+    def get_model_vars_dataframe(self):
+        """Returns the recorded metrics as a DataFrame, one row per step
+
+        Returns:
+            data (pd.DataFrame): recorded values, one column per metric
+
+        """
+        return pd.DataFrame({name: self.get(name) for name in self.model_reporters})
+
+
+class _ModelVars(Mapping):
+    """Read-only mapping of metric name to _MetricSeries """
+    def __init__(self, recorder):
+        self.recorder = recorder
+
+    def __getitem__(self, name):
+        if name not in self.recorder.model_reporters:
+            raise KeyError(name)
+        return _MetricSeries(self.recorder, name)
+
+    def __iter__(self):
+        return iter(self.recorder.model_reporters)
+
+    def __len__(self):
+        return len(self.recorder.model_reporters)
+
+
+class _MetricSeries(Sequence):
+    """Recorded values of a single metric. Values are returned as python numbers (or lists), so
+    they can be serialized to json, e.g. by the ChartModule of the server
+    """
+    def __init__(self, recorder, name):
+        self.recorder = recorder
+        self.name = name
+
+    def __getitem__(self, index):
+        return self.recorder.get(self.name)[index].tolist()
+
+    def __len__(self):
+        return self.recorder.n_records
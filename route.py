@@ -1,7 +1,299 @@
+from collections import deque, OrderedDict
+import heapq
+
 from core import get_distance
 import numpy as np
 
 
+# relative coordinates of the van Neumann neighbourhood, in the order mesa yields them
+NEIGHBOUR_OFFSETS = [(0, -1), (-1, 0), (1, 0), (0, 1)]
+
+
+def distance_field(goal, walkable):
+    """Breadth-first search from goal over the walkable cells of the grid. The result can be
+    shared by every route towards goal, because obstacles never move
+
+    Args:
+        goal (x, y): goal coordinates
+        walkable (2D np array of bool): true for every cell agents are allowed to step on
+
+    Returns:
+        field (2D np array of int): number of steps to goal per cell, -1 if goal is unreachable
+
+    """
+    width, height = walkable.shape
+    field = np.full((width, height), -1, dtype=np.int32)
+    if not walkable[goal]:
+        return field
+
+    field[goal] = 0
+    queue = deque([goal])
+    while queue:
+        x, y = queue.popleft()
+        distance = field[x, y] + 1
+        for dx, dy in NEIGHBOUR_OFFSETS:
+            nx, ny = x + dx, y + dy
+            if 0 <= nx < width and 0 <= ny < height and walkable[nx, ny] and field[nx, ny] < 0:
+                field[nx, ny] = distance
+                queue.append((nx, ny))
+
+    return field
+
+
+class RouteCache:
+    """Bounded cache of found paths with least recently used eviction. Paths are keyed by start,
+    goal, path finding method and the set of forbidden cells, so agents that search the same
+    route again (or the same route as another agent) get a copy of the cached path
+
+    Args:
+        size (int): maximum number of cached paths, 0 disables the cache
+
+    Attributes:
+        size (int): maximum number of cached paths
+        hits (int): number of lookups that found a cached path
+        misses (int): number of lookups that did not find a cached path
+
+    """
+    def __init__(self, size=0):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._paths = OrderedDict()
+
+    def __len__(self):
+        return len(self._paths)
+
+    @staticmethod
+    def key(start, goal, method, forbidden_cells):
+        """Returns the key of a route. The forbidden cells are stored as a frozenset, which keeps
+        its hash, so the key is hashed only once
+
+        Args:
+            start (x, y): start coordinates
+            goal (x, y): goal coordinates
+            method (string): path finding method
+            forbidden_cells (list): cells that are to be avoided
+
+        Returns:
+            key (tuple): key of the route in the cache
+
+        """
+        return start, goal, method, frozenset(forbidden_cells)
+
+    def get(self, key):
+        """Looks up a path and marks it as recently used
+
+        Args:
+            key (tuple): key of the route, see key()
+
+        Returns:
+            found (boolean): if the route is in the cache
+            path (list): copy of the cached path, None if no path exists between start and goal
+
+        """
+        if key not in self._paths:
+            self.misses += 1
+            return False, None
+
+        self.hits += 1
+        self._paths.move_to_end(key)
+        path = self._paths[key]
+        return True, list(path) if path is not None else None
+
+    def put(self, key, path):
+        """Stores a copy of a path, evicting the least recently used path if the cache is full
+
+        Args:
+            key (tuple): key of the route, see key()
+            path (list): path between start and goal, None if no path exists
+
+        """
+        if not self.size:
+            return
+
+        self._paths[key] = tuple(path) if path is not None else None
+        self._paths.move_to_end(key)
+        if len(self._paths) > self.size:
+            self._paths.popitem(last=False)
+
+
+class IncrementalPlanner:
+    """D* Lite path planner (Koenig & Likhachev, 2002) towards a fixed goal. The search runs
+    backwards from the goal and keeps its state between calls to plan(), so when the agent moved
+    a few cells and only a few forbidden cells changed, only the affected part of the search is
+    repaired instead of searching again from scratch
+
+    Args:
+        model: model object the planner is part of
+        grid: grid of environment
+        goal (x, y): goal coordinates
+
+    Attributes:
+        model: model object the planner is part of
+        grid: grid of environment
+        goal (x, y): goal coordinates
+        start (x, y): start coordinates of the last plan
+        forbidden_cells (set): cells that are to be avoided in the last plan
+        expansions (int): number of nodes expanded by the last plan, including the cells
+            visited by the check if start is enclosed
+        total_expansions (int): number of nodes expanded by all plans
+
+    """
+    def __init__(self, model, grid, goal):
+        self.model = model
+        self.grid = grid
+        self.goal = goal
+        self.start = None
+        self.forbidden_cells = set()
+        self.expansions = 0
+        self.total_expansions = 0
+
+        self._g = {}
+        self._rhs = {goal: 0}
+        self._km = 0
+        self._keys = {}
+        self._queue = []
+        self._push(goal)
+
+    def _successors(self, pos):
+        """Returns the cells an agent on pos is allowed to step to """
+        neighbours = self.grid.get_walkable_neighbours(pos)
+        return [cell for cell in neighbours if cell not in self.forbidden_cells]
+
+    def _key(self, pos):
+        """Returns the priority of pos in the queue """
+        g = min(self._g.get(pos, np.inf), self._rhs.get(pos, np.inf))
+        return (g + get_distance(self.start, pos) + self._km, g)
+
+    def _push(self, pos):
+        """Adds pos to the queue, replacing an earlier entry of pos """
+        key = self._key(pos) if self.start is not None else (0, 0)
+        self._keys[pos] = key
+        heapq.heappush(self._queue, (key, pos))
+
+    def _top_key(self):
+        """Returns the smallest key in the queue, dropping outdated entries on the way """
+        while self._queue:
+            key, pos = self._queue[0]
+            if self._keys.get(pos) == key:
+                return key
+            heapq.heappop(self._queue)
+
+        return (np.inf, np.inf)
+
+    def _update_vertex(self, pos):
+        """Recomputes the distance of pos from its successors and queues pos if inconsistent """
+        if pos != self.goal:
+            self._rhs[pos] = min(
+                [self._g.get(cell, np.inf) + 1 for cell in self._successors(pos)], default=np.inf
+            )
+
+        # entries are removed from the queue lazily, by forgetting their key
+        self._keys.pop(pos, None)
+        if self._g.get(pos, np.inf) != self._rhs.get(pos, np.inf):
+            self._push(pos)
+
+    def _compute_shortest_path(self):
+        """Expands inconsistent cells until the distance of the start is known """
+        while self._top_key() < self._key(self.start) \
+                or self._rhs.get(self.start, np.inf) > self._g.get(self.start, np.inf):
+            key_old, pos = heapq.heappop(self._queue)
+            del self._keys[pos]
+            self.expansions += 1
+
+            key_new = self._key(pos)
+            g, rhs = self._g.get(pos, np.inf), self._rhs.get(pos, np.inf)
+            if key_old < key_new:
+                self._push(pos)
+            elif g > rhs:
+                self._g[pos] = rhs
+                for cell in self.grid.get_walkable_neighbours(pos):
+                    self._update_vertex(cell)
+            else:
+                self._g[pos] = np.inf
+                self._update_vertex(pos)
+                for cell in self.grid.get_walkable_neighbours(pos):
+                    self._update_vertex(cell)
+
+    def _enclosed(self, start):
+        """Checks if the forbidden cells (or obstacles) enclose start without the goal. The
+        backward search would have to expand every cell that can reach the goal to find out,
+        while all forbidden cells lie close to start, so a small forward search suffices. The
+        cells it visits are counted as expansions
+
+        Args:
+            start (x, y): start coordinates
+
+        Returns:
+            enclosed (boolean): true if goal can not be reached from start
+
+        """
+        radius = max([get_distance(start, cell) for cell in self.forbidden_cells], default=0) + 1
+        visited = {start}
+        queue = deque([start])
+        while queue:
+            pos = queue.popleft()
+            self.expansions += 1
+            if pos == self.goal or get_distance(start, pos) >= radius:
+                return False
+            for cell in self._successors(pos):
+                if cell not in visited:
+                    visited.add(cell)
+                    queue.append(cell)
+
+        return True
+
+    def plan(self, start, forbidden_cells=[]):
+        """Finds the shortest path from start to goal, avoiding the forbidden cells. Only the
+        cells next to forbidden cells that were added or removed since the last plan are updated
+        before the search is repaired. Ties between equally short steps are broken randomly
+
+        Args:
+            start (x, y): start coordinates
+            forbidden_cells (list): cells that are to be avoided
+
+        Returns:
+            path (list): path from goal to start (excluding start), None if goal is unreachable
+
+        """
+        self.expansions = 0
+        if self.start is not None:
+            self._km += get_distance(self.start, start)
+        self.start = start
+
+        # the cost of stepping onto a cell changes if it enters or leaves the forbidden cells
+        forbidden_cells = set(forbidden_cells)
+        changed = forbidden_cells ^ self.forbidden_cells
+        self.forbidden_cells = forbidden_cells
+        for cell in changed:
+            for neighbour in self.grid.get_walkable_neighbours(cell):
+                self._update_vertex(neighbour)
+
+        if self._enclosed(start):
+            self.total_expansions += self.expansions
+            return None
+
+        self._compute_shortest_path()
+        self.total_expansions += self.expansions
+
+        # the start itself does not have to be expanded, its rhs value is its distance to goal
+        g = self._rhs.get(start, np.inf)
+        if g == np.inf:
+            return None
+
+        # walk downhill from start to goal
+        path = []
+        pos = start
+        while g > 0:
+            g -= 1
+            candidates = [cell for cell in self._successors(pos) if self._g.get(cell) == g]
+            pos = self.model.random.choice(candidates)
+            path.append(pos)
+
+        path.reverse()
+        return path
+
+
 class Position:
     """Position object used by the A* algorithm. Stores necessary attributes for the position
 
@@ -31,8 +323,13 @@ class Route:
         start (pos (x, y)): start coordinates
         goal (pos (x, y)): goal coordinates
         grid: grid of environment
-        forbidden_type (list): what kind of agents are forbidden to step on
+        forbidden_type (list): what kind of agents are forbidden to step on, obstacles are always
+            forbidden
         forbidden_cells (list): cells that are to be avoided
+        method (string: ("astar", "heap", "flowfield", "dstar", "hpa"), optional): path finding
+            method, defaults to the route_method of the model
+        planner (IncrementalPlanner, optional): planner of an earlier route towards the same
+            goal, whose search is repaired instead of searching from scratch (method "dstar")
 
     Attributes:
         model: model object this route is part of
@@ -41,11 +338,25 @@ class Route:
         grid: grid of environment
         forbidden_type (list): what kind of agents are forbidden to step on
         forbidden_cells (list): cells that are to be avoided
-        shortest (list): path between current positon and goal
+        method (string): path finding method
+        planner (IncrementalPlanner): planner that found the route (method "dstar"), else None
+        expansions (int): number of nodes expanded to find the route
+        searched (boolean): if the route was searched, i.e. not taken from the route cache or
+            descended from a flow field
+        cache_hit (boolean): if the route was taken from the route cache
+        shortest (list): path between current positon and goal. With the hierarchical planner
+            (method "hpa") only the first REFINE_AHEAD steps are refined, the rest of the path is
+            refined while the agent moves
+        unrefined_length (int): number of steps of the path that are not in shortest yet
         path_length (int): length of path
 
     """
-    def __init__(self, model, start, goal, grid, forbidden_type=[], forbidden_cells=[]):
+    REFINE_AHEAD = 16   # minimum number of refined steps of a hierarchical path
+
+    def __init__(
+        self, model, start, goal, grid, forbidden_type=[], forbidden_cells=[], method=None,
+        planner=None
+    ):
         self.model = model
         self.start = start
         self.goal = goal
@@ -53,12 +364,25 @@ class Route:
         self.grid = grid
         self.forbidden_type = forbidden_type
         self.forbidden_cells = forbidden_cells
+        self.method = method if method else getattr(model, "route_method", "astar")
+        self.planner = planner if planner and planner.goal == goal else None
+        self.expansions = 0
+        self.searched = False
+        self.cache_hit = False
+        self.unrefined_length = 0
+        self._waypoints = []
         self.shortest = self.find_shortest()
         if self.shortest:
-            self.path_length = len(self.shortest)
+            self.path_length = len(self.shortest) + self.unrefined_length
         else:
             self.path_length = None
 
+        step_stats = getattr(model, "step_stats", None)
+        if step_stats is not None:
+            step_stats["routes"] += self.searched
+            step_stats["route_cache_hits"] += self.cache_hit
+            step_stats["expansions"] += self.expansions
+
     def move_agent(self, agent):
         """Moves the agent to the next step, updates the list and self.path_length
 
@@ -69,6 +393,8 @@ class Route:
         self.model.grid.move_agent(agent, self.shortest[-1])
         self.shortest.pop()
         self.path_length -= 1
+        if self._waypoints and len(self.shortest) < self.REFINE_AHEAD:
+            self.refine()
 
     def get_possible_neighborhood(self, pos, forbidden_cells=[]):
         """Returns all the possible locations to walk to directly next to agent
@@ -82,24 +408,29 @@ class Route:
 
         """
         possible = []
-        candidates = self.grid.get_neighborhood(pos, False, radius=1)
+        walkable = self.grid.walkable
+        width, height = walkable.shape
+        x, y = pos
+
+        for dx, dy in NEIGHBOUR_OFFSETS:
+            candidate = (x + dx, y + dy)
 
-        for candidate in candidates:
+            # obstacles are never walkable, they are stored in the obstacle layer of the grid
+            if not (0 <= candidate[0] < width and 0 <= candidate[1] < height) \
+                    or not walkable[candidate]:
+                continue
 
             # check if the cell position is in the forbidden location list
             if candidate in forbidden_cells:
                 continue
 
-            content_list = self.grid.get_cell_list_contents(candidate)
-            valid = True
-            for content in content_list:
-
-                # check if the agent type is in the forbidden agent type list
-                if type(content) in self.forbidden_type:
-                    valid = False
+            # check if the agent type is in the forbidden agent type list
+            if self.forbidden_type:
+                content_list = self.grid.get_cell_list_contents(candidate)
+                if any(type(content) in self.forbidden_type for content in content_list):
                     continue
-            if valid:
-                possible.append(candidate)
+
+            possible.append(candidate)
 
         return possible
 
@@ -119,22 +450,128 @@ class Route:
             vision = path_length
 
         cells = self.shortest[-vision:]
+        scores = self.grid.scores
         score = 0
         for cell in cells:
-            correction = 0
-            if agent_pos:
-                distance = get_distance(agent_pos, cell)
-                if distance <= self.model.AVOID_RADIUS:
-                    correction = self.model.AVOID_RADIUS + 1 - distance
+            score += scores[cell]
 
-            score += self.grid.get_score(cell) - correction
+        # correct for the agent's own score on the cells within its avoid radius
+        if agent_pos:
+            radius = self.model.AVOID_RADIUS
+            x, y = agent_pos
+            for cell_x, cell_y in cells:
+                distance = abs(cell_x - x) + abs(cell_y - y)
+                if distance <= radius:
+                    score -= radius + 1 - distance
 
-        return score
+        return int(score)
 
     def find_shortest(self):
-        """Find shortest route using manhattan metric """
+        """Find shortest route using manhattan metric, or take it from the route cache of the
+        model. Routes that avoid agent types depend on the agents around, so they are not cached
+        """
+        cache = getattr(self.model, "route_cache", None)
+        if cache is None or not cache.size or self.forbidden_type \
+                or (self.method == "hpa" and not self.forbidden_cells):
+            return self.search_shortest()
+
+        key = cache.key(self.start, self.goal, self.method, self.forbidden_cells)
+        found, path = cache.get(key)
+        self.cache_hit = found
+        if not found:
+            path = self.search_shortest()
+            cache.put(key, path)
+
+        return path
+
+    def search_shortest(self):
+        """Search shortest route using manhattan metric. A flow field only knows about the static
+        obstacles, so routes that avoid forbidden cells or agent types are searched with the heap
+        based A*. The same holds for the abstract graph of the hierarchical planner. The
+        incremental planner avoids forbidden cells, but not agent types, so routes that avoid
+        agent types are searched with the heap based A* as well
+        """
+        if self.method == "hpa" and not self.forbidden_cells and not self.forbidden_type:
+            self.searched = True
+            return self.plan_hierarchical()
+        if self.method == "dstar" and not self.forbidden_type:
+            self.searched = True
+            if self.planner is None:
+                self.planner = IncrementalPlanner(self.model, self.grid, self.goal)
+            path = self.planner.plan(self.start, self.forbidden_cells)
+            self.expansions = self.planner.expansions
+            return path
+        if self.method == "flowfield" and not self.forbidden_cells and not self.forbidden_type:
+            return self.descend_flow_field()
+
+        self.searched = True
+        if self.method in ("heap", "hpa", "dstar", "flowfield"):
+            return self.a_star_heap("manhattan")
         return self.a_star("manhattan")
 
+    def plan_hierarchical(self):
+        """Searches the abstract graph of the floorplan (see hierarchy.AbstractGraph) and only
+        refines the first steps of the path
+
+        Returns:
+            path (list): first steps of the path from goal to start (excluding start), None if
+                goal is unreachable
+
+        """
+        graph = self.model.get_abstract_graph()
+        nodes, length, self.expansions = graph.find_abstract_path(self.start, self.goal)
+        if nodes is None:
+            return None
+
+        self._waypoints = nodes[1:]
+        self._waypoints.reverse()
+        self.unrefined_length = length
+        self.shortest = []
+        self.refine()
+
+        return self.shortest
+
+    def refine(self):
+        """Refines the next edges of a hierarchical path until at least REFINE_AHEAD steps of
+        the path are refined, or the whole path is refined
+        """
+        graph = self.model.get_abstract_graph()
+        while self._waypoints and len(self.shortest) < self.REFINE_AHEAD:
+            end = self.shortest[0] if self.shortest else self.start
+            cells, expansions = graph.refine(end, self._waypoints.pop())
+            self.expansions += expansions
+            self.unrefined_length -= len(cells)
+            self.shortest[:0] = reversed(cells)
+
+    def descend_flow_field(self):
+        """Follows the cached distance field of the goal downhill from start to goal. Ties between
+        equally short steps are broken randomly, just like in a_star()
+
+        Returns:
+            path (list): path from goal to start (excluding start), None if goal is unreachable
+
+        """
+        field = self.model.get_flow_field(self.goal)
+        width, height = field.shape
+        x, y = self.start
+        distance = field[x, y]
+        if distance < 0:
+            return None
+
+        path = []
+        while distance > 0:
+            distance -= 1
+            candidates = []
+            for dx, dy in NEIGHBOUR_OFFSETS:
+                nx, ny = x + dx, y + dy
+                if 0 <= nx < width and 0 <= ny < height and field[nx, ny] == distance:
+                    candidates.append((nx, ny))
+            x, y = self.model.random.choice(candidates)
+            path.append((x, y))
+
+        path.reverse()
+        return path
+
     def a_star(self, distance_method):
         """A* path finding algorithm.
         Based on pseudocode on Wikipedia: https://en.wikipedia.org/wiki/A*_search_algorithm
@@ -152,6 +589,7 @@ class Route:
         while unexplored:
             minimum = min(unexplored.values(), key=lambda x: x.f_score)
             current = self.model.random.choice([val for val in unexplored.values() if val.f_score == minimum.f_score])
+            self.expansions += 1
 
             # check if we reached the destination
             if current.pos == self.goal:
@@ -187,3 +625,64 @@ class Route:
                     neighbour.parent = current
                     if neighbour.pos not in unexplored:
                         unexplored[neighbour.pos] = neighbour
+
+    def a_star_heap(self, distance_method):
+        """A* path finding algorithm with a binary heap as open list and a closed set. Entries in
+        the heap are never updated; outdated entries are skipped when popped (lazy deletion).
+        Every entry gets a random key from model.random, so ties in f_score are broken uniformly
+        at random like in a_star()
+
+        Args:
+            distance_method (string: ("chebyshev", "manhattan", "euclidean"), optional):
+                distance metric
+
+        """
+        forbidden_cells = set(self.forbidden_cells)
+        random = self.model.random.random
+
+        start_object = Position(self.start, 0, get_distance(self.start, self.goal))
+        explored = {self.start: start_object}
+        closed = set()
+        unexplored = [(start_object.f_score, random(), self.start)]
+
+        # keep exploring until destination found or no tiles left to explore
+        while unexplored:
+            f_score, _, pos = heapq.heappop(unexplored)
+            current = explored[pos]
+
+            # skip entries of positions that were expanded before or got a better score since
+            if pos in closed or f_score != current.f_score:
+                continue
+            self.expansions += 1
+
+            # check if we reached the destination
+            if pos == self.goal:
+
+                # found goal, reconstruct the most efficient route
+                queue = []
+                while current.parent:
+                    queue.append(current.pos)
+                    current = current.parent
+
+                return queue
+
+            closed.add(pos)
+
+            # check all the neighbours
+            for neighbour_pos in self.get_possible_neighborhood(pos, forbidden_cells):
+                if neighbour_pos in closed:
+                    continue
+
+                if neighbour_pos in explored:
+                    neighbour = explored[neighbour_pos]
+                else:
+                    neighbour = explored[neighbour_pos] = Position(neighbour_pos)
+
+                tentative_g_score = current.g_score + get_distance(pos, neighbour_pos, distance_method)
+                if tentative_g_score < neighbour.g_score:
+
+                    # better score, save new calculated score
+                    neighbour.g_score = tentative_g_score
+                    neighbour.f_score = tentative_g_score + get_distance(neighbour_pos, self.goal, distance_method)
+                    neighbour.parent = current
+                    heapq.heappush(unexplored, (neighbour.f_score, random(), neighbour_pos))
@@ -0,0 +1,71 @@
+from mesa.time import BaseScheduler
+import numpy as np
+
+
+class ArrayActivation(BaseScheduler):
+    """Scheduler that activates each agent once per step in random order, like the mesa
+    RandomActivation. Agents are kept in a dense list with swap-remove, and the random order of
+    a step is a single NumPy permutation of its indices. The ordered dict of mesa is kept up to
+    date as well, so the rest of the mesa API keeps working
+
+    Args:
+        model: model object this scheduler is part of
+
+    Attributes:
+        model: model object this scheduler is part of
+        steps (int): number of steps taken
+        time (int): time of the simulation
+
+    """
+    def __init__(self, model):
+        super().__init__(model)
+        self._agent_list = []
+        self._index = {}
+
+    def add(self, agent):
+        """Adds an agent to the schedule
+
+        Args:
+            agent (Agent): agent with a step() method
+
+        """
+        super().add(agent)
+        self._index[agent.unique_id] = len(self._agent_list)
+        self._agent_list.append(agent)
+
+    def remove(self, agent):
+        """Removes an agent from the schedule, by moving the last agent into its place
+
+        Args:
+            agent (Agent): agent to remove
+
+        """
+        super().remove(agent)
+        index = self._index.pop(agent.unique_id)
+        last = self._agent_list.pop()
+        if last is not agent:
+            self._agent_list[index] = last
+            self._index[last.unique_id] = index
+
+    def step(self):
+        """Executes the step of all agents, one at a time, in random order. The permutation is
+        seeded from the random number generator of the model, so reseeding the model (e.g. when
+        forking it) also changes the order. Agents removed during the step are skipped
+        """
+        agents = list(self._agent_list)
+        generator = np.random.default_rng(self.model.random.getrandbits(64))
+        for index in generator.permutation(len(agents)).tolist():
+            agent = agents[index]
+            if agent.unique_id in self._index:
+                agent.step()
+
+        self.steps += 1
+        self.time += 1
+
+    def get_agent_count(self):
+        """Returns the number of agents in the schedule """
+        return len(self._agent_list)
+
+    @property
+    def agents(self):
+        return list(self._agent_list)
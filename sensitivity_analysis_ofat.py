@@ -1,3 +1,5 @@
+import glob
+import os
 import time
 import csv
 import numpy as np
@@ -7,22 +9,79 @@ from SALib.analyze import sobol
 import pandas as pd
 
 from model import CovidSupermarketModel
+from store import ResultStore
 import core
+import ensemble
 
 
-def saver(dictex):
-    """Save dictionary of pandas dataframes. Based on code from stackoverflow:
-    https://stackoverflow.com/questions/50786266/writing-dictionary-of-dataframes-to-file.
+# columns of the store with the results of the OFAT sensitivity analysis. A sweep is identified
+# by its base seed and burn-in
+COLUMNS = [
+    ("base_seed", "i8"), ("burn_in", "i4"), ("parameter", "U16"), ("sample", "i4"),
+    ("value", "f8"), ("replicate", "i4"), ("step", "i4"), ("n_problematic_contacts", "i4")
+]
+
+# base seed of the results imported from csv files, which were not seeded. Their sample index is
+# not known either, it is stored as -1
+LEGACY_SEED = -1
+
+
+def saver(store, sweep, var_name, index, sample, replicate, data):
+    """Appends the data of a single run to the results store
 
     Args:
-        dictex (dict): dict of pandas dataframes
+        store (ResultStore): store of the sweep
+        sweep (tuple (int, int)): base seed and burn-in of the sweep
+        var_name (string): name of the varied parameter
+        index (int): index of the sample of the varied parameter. Integer parameters can have
+            the same value for several samples
+        sample (float): value of the varied parameter
+        replicate (int): replicate number of the run
+        data (pd.DataFrame): model variables collected during the run, one row per step
+
+    """
+    store.append(
+        base_seed=sweep[0], burn_in=sweep[1], parameter=var_name, sample=index, value=sample,
+        replicate=replicate, step=np.arange(len(data)),
+        n_problematic_contacts=data["n_problematic_contacts"].values
+    )
+
+
+def stored_runs(store, sweep):
+    """Returns the runs of a sweep that are already in the store
+
+    Args:
+        store (ResultStore): store of the sweep
+        sweep (tuple (int, int)): base seed and burn-in of the sweep
+
+    Returns:
+        runs (set of tuples (parameter, sample, value, replicate)): runs of the sweep in the
+            store
 
     """
-    for key, val in dictex.items():
-        val.to_csv("results/data_{}.csv".format(str(key)))
+    records = store.load(steps=(0, 1), base_seed=sweep[0], burn_in=sweep[1])
+    return set(zip(*[
+        records[name].tolist() for name in ("parameter", "sample", "value", "replicate")
+    ]))
 
-    with open("results/keys_{}.txt".format(str(key)), "w") as f:  # saving keys to file
-        f.write(str(list(dictex.keys())))
+
+def import_csv_results(store, directory="results"):
+    """Imports results that were saved as one csv file per run, i.e. the files
+    data_{parameter}_{value}_{replicate}.csv in the directories results/OFAT_*. The runs get
+    base seed LEGACY_SEED, runs that were imported before are skipped
+
+    Args:
+        store (ResultStore): store to append the results to
+        directory (string): directory containing the OFAT_* directories
+
+    """
+    sweep = (LEGACY_SEED, 0)
+    done = stored_runs(store, sweep)
+    for path in sorted(glob.glob(os.path.join(directory, "OFAT_*", "data_*.csv"))):
+        name = os.path.basename(path)[len("data_"):-len(".csv")]
+        var_name, sample, replicate = name.rsplit("_", 2)
+        if (var_name, -1, float(sample), int(replicate)) not in done:
+            saver(store, sweep, var_name, -1, float(sample), int(replicate), pd.read_csv(path))
 
 
 def generate_samples(problem, var_name, distinct_samples):
@@ -47,12 +106,22 @@ def generate_samples(problem, var_name, distinct_samples):
             return samples
 
 
-def main():
+def main(n_workers=None, base_seed=0, burn_in=0):
+    """Runs the OFAT sensitivity analysis. All runs are spread over a pool of worker processes,
+    the results are collected in the store results/OFAT.dat
 
-    # load supermarket floorplan for simulation
-    floorplan = core.load_floorplan("data/albert_excel_test.csv")
-    width = len(floorplan)
-    height = len(floorplan[0])
+    Args:
+        n_workers (int, optional): number of worker processes, defaults to the number of cores
+        base_seed (int): seed of the analysis, every run gets its own seed derived from it
+        burn_in (int): number of steps the replicates of a sample share. The replicates are
+            forked from a single model that ran the burn-in, and only simulate the remaining
+            steps with their own seed. No burn-in is shared by default. Runs with the same base
+            seed and burn-in that are already in the store are skipped, so running the analysis
+            again resumes it instead of duplicating its records
+
+    """
+    # supermarket floorplan for simulation, loaded once by every worker
+    floorplan_path = "data/albert_excel_test.csv"
 
     problem = {
     "num_vars": 5,
@@ -67,39 +136,37 @@ def main():
 
     time_start = time.time()
 
-    # perform OFAT for each variable in problem
-    for var_name in problem["names"]:
-
+    # runs of this sweep that are already in the store are not run again, so an interrupted sweep
+    # can be resumed without duplicating records
+    sweep = (base_seed, burn_in)
+    store = ResultStore("results/OFAT.dat", COLUMNS)
+    done = stored_runs(store, sweep)
+
+    # create a run for each replicate of each sample of each variable in problem. Default values
+    # for the other parameters are specified in model.py in the __init__ declaration of
+    # CovidSupermarketModel
+    jobs = []
+    for i, var_name in enumerate(problem["names"]):
         samples = generate_samples(problem, var_name=var_name, distinct_samples=distinct_samples)
-
-        for sample in samples:
-            print("\nCalculating sample {} = {} out of \n{}".format(var_name, sample, samples))
-            datas = {}
+        for j, sample in enumerate(samples):
             for replicate in range(replicates):
-
-                # run appropriate model with correct variable parameter
-                # default values for the other parameters are specified in model.py in the
-                # __init__ declaration of CovidSupermarketModel
-                if var_name == "N_customers":
-                    model = CovidSupermarketModel(floorplan, width, height, N_customers=sample)
-                elif var_name == "vaccination_prop":
-                    model = CovidSupermarketModel(floorplan, width, height, vaccination_prop=sample)
-                elif var_name == "len_shoplist":
-                    model = CovidSupermarketModel(floorplan, width, height, len_shoplist=sample)
-                elif var_name == "basic_compliance":
-                    model = CovidSupermarketModel(floorplan, width, height, basic_compliance=sample)
-                elif var_name == "vision":
-                    model = CovidSupermarketModel(floorplan, width, height, vision=sample)
-                else:
-                    raise ValueError("ERROR! Wrong variable name selected!")
-
-                model.run_model(n_steps)
-
-                datas["{}_{}_{}".format(var_name, sample, replicate)] = model.datacollector.\
-                    get_model_vars_dataframe()
-
-            # save data
-            saver(datas)
+                if (var_name, j, float(sample), replicate) in done:
+                    continue
+                job = (
+                    (var_name, j, sample, replicate), {var_name: sample}, n_steps,
+                    ensemble.job_seed(base_seed, i, j, replicate)
+                )
+                if burn_in:
+                    job += ((burn_in, ensemble.job_seed(base_seed, i, j)),)
+                jobs.append(job)
+
+    # append the data of each run to the store as soon as it is done
+    for count, ((var_name, j, sample, replicate), data) in enumerate(
+            ensemble.run_ensemble(jobs, floorplan_path, n_workers, replicates)):
+        saver(store, sweep, var_name, j, sample, replicate, data)
+        print("Finished {} = {}, replicate {} ({} out of {} runs)".format(
+            var_name, sample, replicate, count + 1, len(jobs))
+        )
 
     print("\nTotal simulation time: {:.2f}s".format(time.time()-time_start))
 
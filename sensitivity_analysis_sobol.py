@@ -1,3 +1,7 @@
+import argparse
+import glob
+import json
+import os
 import time
 import csv
 import numpy as np
@@ -8,7 +12,15 @@ from SALib.analyze import sobol
 import pandas as pd
 
 from model import CovidSupermarketModel
-import core
+import ensemble
+import floorplan as floorplans
+
+
+# columns of the sweep logs. The first five are the parameters, in the order of problem["names"]
+COLUMNS = [
+    "N_customers", "vaccination_prop", "len_shoplist", "basic_compliance", "vision", "run",
+    "n_problematic_contacts", "n_problematic_contacts_mean", "n_problematic_contacts_mean_100"
+]
 
 
 def plot_index(s, params, i, title=""):
@@ -38,32 +50,329 @@ def plot_index(s, params, i, title=""):
     plt.savefig("./results/Sobol_{}_paper.png".format(i))
 
 
-def generate_samples(problem, distinct_samples, sample_index):
+def generate_samples(problem, distinct_samples, shard=0, n_shards=1):
     """Generate samples for Sobol analysis for given problem
 
     Args:
         problem (dict): dict of parameters of the model and their bounds
         distinct_samples (int): number of distinct samples Sobol SA
-        sample_index (int <- [0, 5)): select which fifth part of parameter array to generate samples
+        shard (int <- [0, n_shards)): select which part of parameter array to generate samples
+        n_shards (int): number of parts to split the parameter array in
 
     Returns:
+        indices (np array): row indices of the samples in the full sample matrix
         samples (2D np array): array of parameter value configurations
 
     """
     params = saltelli.sample(problem, distinct_samples, calc_second_order=False)
-    len_params = len(params)
-    params_array = [params[i * int(len_params/5): (i+1) * int(len_params/5)] for i in range(5)]
+    indices = np.array_split(np.arange(len(params)), n_shards)[shard]
+
+    return indices, params[indices]
+
+
+def sample_values(vals):
+    """Converts a row of the sample matrix to the parameter values of the model, i.e. rounds
+    the parameters that should be integers (index 0, 2 and 4) down
+
+    Args:
+        vals (np array): row of the sample matrix
+
+    Returns:
+        vals (list): parameter values in the order of problem["names"]
+
+    """
+    vals = list(vals)
+    vals[0] = int(vals[0])
+    vals[2] = int(vals[2])
+    vals[4] = int(vals[4])
+    return vals
+
+
+def sweep_config(problem, distinct_samples, n_steps, base_seed, floorplan_path):
+    """Configuration of a sweep, i.e. everything that determines the parameters and the seed of
+    its runs
+
+    Args:
+        problem (dict): dict of parameters of the model and their bounds
+        distinct_samples (int): number of distinct samples Sobol SA
+        n_steps (int): number of steps per run
+        base_seed (int): seed of the sweep
+        floorplan_path (string): csv file containing layout of supermarket
+
+    Returns:
+        config (dict): configuration of the sweep
+
+    """
+    return {
+        "names": list(problem["names"]), "bounds": [list(bounds) for bounds in problem["bounds"]],
+        "distinct_samples": distinct_samples, "n_steps": n_steps, "base_seed": base_seed,
+        "floorplan": floorplan_path
+    }
+
+
+def check_sweep(log_dir, config, create=False):
+    """Checks that the logs in log_dir belong to the sweep with the given configuration. The
+    configuration is stored in log_dir/sweep.json by the first shard that runs, logs of a sweep
+    with another configuration need a log directory of their own
 
-    return params_array[sample_index]
+    Args:
+        log_dir (string): directory of the logs of the sweep
+        config (dict): configuration of the sweep, see sweep_config()
+        create (boolean): store the configuration if log_dir does not have one yet
+
+    Raises:
+        ValueError: if log_dir contains the logs of a sweep with another configuration
+
+    """
+    path = os.path.join(log_dir, "sweep.json")
+    if not os.path.exists(path):
+        if not create:
+            return
+        os.makedirs(log_dir, exist_ok=True)
+        with open(path, "w") as file:
+            json.dump(config, file, indent=2)
+        return
+
+    with open(path) as file:
+        stored = json.load(file)
+    if stored != json.loads(json.dumps(config)):
+        raise ValueError(
+            "{} contains the logs of sweep {}, not of sweep {}. Use another log directory."
+            .format(log_dir, stored, config)
+        )
 
 
-def main():
+def check_rows(rows, params):
+    """Checks that the logged parameter values of every run match its row of the sample matrix
+
+    Args:
+        rows (dict {int: list}): values of each finished run, by run index, see read_log()
+        params (2D np array): full sample matrix
 
-    # load supermarket floorplan for simulation
-    floorplan = core.load_floorplan("data/albert_excel_test.csv")
+    Raises:
+        ValueError: if a run is not part of the sample matrix or has other parameter values
+
+    """
+    for index, values in rows.items():
+        if index >= len(params) or values[:5] != sample_values(params[index]):
+            raise ValueError(
+                "Run {} with parameters {} does not belong to the sample matrix of the sweep."
+                .format(index, values[:5])
+            )
+
+
+def log_path(log_dir, shard, n_shards):
+    """Path of the append-only log of a shard
+
+    Args:
+        log_dir (string): directory of the logs of the sweep
+        shard (int <- [0, n_shards)): index of the shard
+        n_shards (int): number of shards of the sweep
+
+    Returns:
+        path (string): csv file of the shard
+
+    """
+    return os.path.join(log_dir, "shard_{}_of_{}.csv".format(shard, n_shards))
+
+
+def read_log(path):
+    """Reads the finished runs from a sweep log. Only rows that end with a newline are finished,
+    a last row without one was cut off by a crash and is skipped, even if its values parse
+
+    Args:
+        path (string): csv file of a shard
+
+    Returns:
+        rows (dict {int: list}): values of each finished run, by run index
+
+    """
+    rows = {}
+    if not os.path.exists(path):
+        return rows
+
+    with open(path, newline="") as file:
+        lines = file.read().split("\n")[:-1]
+
+    for row in csv.reader(lines):
+        if row == COLUMNS or len(row) != len(COLUMNS):
+            continue
+        try:
+            values = [float(value) for value in row]
+        except ValueError:
+            continue
+        rows[int(values[5])] = values
+
+    return rows
+
+
+def run_shard(
+    problem, distinct_samples, n_steps, shard=0, n_shards=1, log_dir="results/Sobol",
+    floorplan_path="data/albert_excel_test.csv", base_seed=0
+):
+    """Runs the samples of a single shard of the Sobol sweep. Each finished run is appended to
+    the log of the shard and flushed to disk, runs that are already in the log are skipped, so
+    an interrupted shard can be resumed by running it again
+
+    Args:
+        problem (dict): dict of parameters of the model and their bounds
+        distinct_samples (int): number of distinct samples Sobol SA
+        n_steps (int): number of steps per run
+        shard (int <- [0, n_shards)): index of the shard to run
+        n_shards (int): number of shards of the sweep
+        log_dir (string): directory of the logs of the sweep
+        floorplan_path (string): csv file containing layout of supermarket
+        base_seed (int): seed of the sweep, every run gets its own seed derived from it
+
+    Raises:
+        ValueError: if log_dir contains the logs of a sweep with another configuration
+
+    """
+    config = sweep_config(problem, distinct_samples, n_steps, base_seed, floorplan_path)
+    check_sweep(log_dir, config, create=True)
+    floorplan = floorplans.load(floorplan_path)
     width = len(floorplan)
     height = len(floorplan[0])
 
+    indices, params = generate_samples(problem, distinct_samples, shard, n_shards)
+    path = log_path(log_dir, shard, n_shards)
+    finished = read_log(path)
+    check_rows(finished, saltelli.sample(problem, distinct_samples, calc_second_order=False))
+
+    print("Running shard {} out of {}: {} samples, {} already finished".format(
+        shard, n_shards, len(indices), len(finished))
+    )
+    print("Estimated time: {:.2f} hours\n".format((len(indices) - len(finished)) * 2 / 60))
+
+    # drop a last row that was cut off by a crash, so the run is done again and appended whole
+    os.makedirs(log_dir, exist_ok=True)
+    if os.path.exists(path):
+        with open(path, "rb+") as file:
+            content = file.read()
+            if content and not content.endswith(b"\n"):
+                file.truncate(content.rfind(b"\n") + 1)
+
+    with open(path, "a", newline="") as file:
+        if file.tell() == 0:
+            file.write(",".join(COLUMNS) + "\n")
+
+        time_start = time.time()
+        for i, (index, vals) in enumerate(zip(indices, params)):
+            if index in finished:
+                continue
+
+            # change parameters that should be integers i.e. index 0, 2, 4
+            vals = sample_values(vals)
+
+            print("Progress: {:.2%}".format(float(i)/len(indices)))
+            print("Calculating sample {}".format(vals))
+
+            model = CovidSupermarketModel(
+                floorplan, width, height, vals[0], vals[1], vals[2], vals[3], vals[4],
+                seed=ensemble.job_seed(base_seed, index)
+            )
+            model.run_model(n_steps)
+
+            data_run = model.datacollector.get_model_vars_dataframe()["n_problematic_contacts"]
+            row = vals + [
+                index, int(data_run.iloc[-1]), float(np.mean(data_run)),
+                float(np.mean(data_run[100:]))
+            ]
+            file.write(",".join(str(value) for value in row) + "\n")
+            file.flush()
+            os.fsync(file.fileno())
+
+        print("\nTotal simulation time: {:.2f}s".format(time.time()-time_start))
+
+
+def load_results(
+    problem, distinct_samples, n_steps, log_dir="results/Sobol",
+    floorplan_path="data/albert_excel_test.csv", base_seed=0
+):
+    """Merges the logs of all shards of a sweep into the full sample matrix, in sample order.
+    Logs of the same sweep run with different numbers of shards can be merged, the index of a
+    run does not depend on the shards
+
+    Args:
+        problem (dict): dict of parameters of the model and their bounds
+        distinct_samples (int): number of distinct samples Sobol SA
+        n_steps (int): number of steps per run
+        log_dir (string): directory of the logs of the sweep
+        floorplan_path (string): csv file containing layout of supermarket
+        base_seed (int): seed of the sweep
+
+    Returns:
+        data (pd.DataFrame): one row per sample of the full sample matrix
+
+    Raises:
+        ValueError: if log_dir contains the logs of a sweep with another configuration, if a
+            logged run does not match the sample matrix or if samples of the sweep are missing
+
+    """
+    config = sweep_config(problem, distinct_samples, n_steps, base_seed, floorplan_path)
+    check_sweep(log_dir, config)
+    params = saltelli.sample(problem, distinct_samples, calc_second_order=False)
+    n_samples = len(params)
+
+    rows = {}
+    for path in sorted(glob.glob(os.path.join(log_dir, "shard_*_of_*.csv"))):
+        shard_rows = read_log(path)
+        check_rows(shard_rows, params)
+        for index, values in shard_rows.items():
+            rows.setdefault(index, values)
+
+    missing = [index for index in range(n_samples) if index not in rows]
+    if missing:
+        raise ValueError(
+            "{} out of {} samples are missing in {}, first missing sample is {}."
+            .format(len(missing), n_samples, log_dir, missing[0])
+        )
+
+    data = pd.DataFrame([rows[index] for index in range(n_samples)], columns=COLUMNS)
+    data["run"] = data["run"].astype(int)
+
+    return data
+
+
+def load_legacy_results(problem, distinct_samples, sample_index_count=5):
+    """Loads results of the old sweep, which saved its whole dataframe after every sample in a
+    file named after the first sample and the sample count of each fifth of the sample matrix
+
+    Args:
+        problem (dict): dict of parameters of the model and their bounds
+        distinct_samples (int): number of distinct samples Sobol SA
+        sample_index_count (int): number of parts the sample matrix was split in
+
+    Returns:
+        data (pd.DataFrame): one row per sample of the full sample matrix
+
+    """
+    params = saltelli.sample(problem, distinct_samples, calc_second_order=False)
+    len_part = int(len(params) / sample_index_count)
+
+    datas = []
+    for i in range(sample_index_count):
+        data_params = params[i * len_part: (i+1) * len_part]
+        data_count = len(data_params) - 1
+        datas.append(
+            pd.read_csv("results/Sobol/data_{}_{}.csv".format(
+                str([float(value) for value in data_params[0]]).replace(",", "").replace(" ", "_"),
+                data_count)
+            )
+        )
+
+    return pd.concat(datas, ignore_index=True, sort=False)
+
+
+def main(shard=None, n_shards=1, legacy=False):
+    """Runs a shard of the Sobol sweep, or analyzes the results if no shard is given
+
+    Args:
+        shard (int <- [0, n_shards), optional): index of the shard to run
+        n_shards (int): number of shards to split the sweep in
+        legacy (boolean): analyze the results of the old sweep
+
+    """
     problem = {
         "num_vars": 5,
         "names": ["N_customers", "vaccination_prop", "len_shoplist", "basic_compliance", "vision"],
@@ -74,95 +383,14 @@ def main():
     distinct_samples = 500   # 500
     n_steps = 500       # 500
 
-    # you can use this to calculate only fifth parts of the sample matrix when setting sample_index
-    # to a value between 0 and 5
-    # for sample_index in range(5):
-    #
-    #     print("Using sample_index {}".format(sample_index))
-    #     print("Using {} distinct samples in total\n".format(distinct_samples))
-    #
-    #     params = generate_samples(problem, distinct_samples, sample_index)
-    #
-    #     print("Estimated time: {:.2f} hours".format(len(params)*2/60))
-    #     print("Estimated time per computer (5): {:.2f} hours\n".format((len(params)*2/60)/5))
-    #
-    #     data = pd.DataFrame(
-    #         index=range(len(params)),
-    #         columns=[
-    #             "N_customers", "vaccination_prop", "len_shoplist", "basic_compliance", "vision",
-    #             "run", "n_problematic_contacts", "n_problematic_contacts_mean",
-    #             "n_problematic_contacts_mean_100"
-    #         ]
-    #     )
-    #
-    #     time_start = time.time()
-    #
-    #     count = 0
-    #     for i, vals in enumerate(params):
-    #
-    #         # change parameters that should be integers i.e. index 0, 2, 4
-    #         vals = list(vals)
-    #         vals[0] = int(vals[0])
-    #         vals[2] = int(vals[2])
-    #         vals[4] = int(vals[4])
-    #
-    #         print("Progress: {:.2%}".format(float(i)/len(params)))
-    #         print("Calculating sample {}".format(vals))
-    #
-    #         model = CovidSupermarketModel(
-    #             floorplan, width, height, vals[0], vals[1], vals[2], vals[3], vals[4]
-    #         )
-    #         model.run_model(n_steps)
-    #
-    #         data_run = model.datacollector.get_model_vars_dataframe()
-    #         data_run_n_problematic_contacts = data_run.iloc[-1]
-    #         data_run_n_problematic_contacts_mean = np.mean(data_run["n_problematic_contacts"])
-    #         data_run_n_problematic_contacts_mean_100 = np.mean(
-    #             data_run["n_problematic_contacts"][100:]
-    #         )
-    #
-    #         data.iloc[count, 5] = count
-    #         data.iloc[count, 6] = int(data_run_n_problematic_contacts)
-    #         data.iloc[count, 7] = float(data_run_n_problematic_contacts_mean)
-    #         data.iloc[count, 8] = float(data_run_n_problematic_contacts_mean_100)
-    #         data.iloc[count, 0:5] = vals
-    #
-    #         # save dataframe each iteration to prevent losing data. If all goes well, then only the
-    #         # last saved dataframe should be used for analysis
-    #         data.to_csv(
-    #             "results/Sobol/data_{}_{}.csv".format(
-    #                 str(list(data_params[0])).replace(",", "").replace(" ", "_"), count
-    #             )
-    #         )
-    #         count += 1
-    #
-    #     print("\nTotal simulation time: {:.2f}s".format(time.time()-time_start))
-
-    # this is for analyzing. Comment when doing the actual runs
-    # unnamed column is the original index column of the original dataframe
-    data_analyze = pd.DataFrame(
-        index=range(0),
-        columns=[
-            "N_customers", "vaccination_prop", "len_shoplist", "basic_compliance", "vision", "run",
-            "n_problematic_contacts", "n_problematic_contacts_mean",
-            "n_problematic_contacts_mean_100"
-        ]
-    )
-    datas = []
-    for i in range(5):
-        data_params = generate_samples(problem, distinct_samples, i)
-        data_count = len(data_params) - 1
-        datas.append(
-            pd.read_csv("results/Sobol/data_{}_{}.csv".format(
-                str(list(data_params[0])).replace(",", "").replace(" ", "_"), data_count)
-            )
-        )
+    if shard is not None:
+        run_shard(problem, distinct_samples, n_steps, shard, n_shards)
+        return
 
-    data = pd.concat(
-        [data_analyze, datas[0], datas[1], datas[2], datas[3], datas[4]],
-        ignore_index=True,
-        sort=False
-    )
+    if legacy:
+        data = load_legacy_results(problem, distinct_samples)
+    else:
+        data = load_results(problem, distinct_samples, n_steps)
 
     Si_problematic_contacts = sobol.analyze(
         problem,
@@ -181,4 +409,10 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Sobol sensitivity analysis")
+    parser.add_argument("--shard", type=int, help="index of the shard to run, analyze if omitted")
+    parser.add_argument("--n-shards", type=int, default=1, help="number of shards of the sweep")
+    parser.add_argument("--legacy", action="store_true", help="analyze results of the old sweep")
+    args = parser.parse_args()
+
+    main(args.shard, args.n_shards, args.legacy)
@@ -2,9 +2,10 @@ from mesa.visualization.modules import CanvasGrid, ChartModule
 from mesa.visualization.ModularVisualization import ModularServer
 from mesa.visualization.UserParam import UserSettableParameter
 from collections import defaultdict
+import numpy as np
 
 import model
-import core
+import floorplan as floorplans
 from agent import Customer, Obstacle
 
 # dictionary containing color scales for heat map
@@ -63,34 +64,131 @@ color_dict = {
 
 
 class CanvasGridCustom(CanvasGrid):
-    """Overrides the default canvas grid to also handle empty cells """
+    """Overrides the default canvas grid to also handle empty cells. With delta enabled the
+    obstacles are sent once per model, after that only the cells that changed since the previous
+    frame are sent. The client (DeltaCanvasModule.js) keeps the portrayals of all cells and
+    applies the changes
+
+    Args:
+        portrayal_method: function to convert each object on the grid to a portrayal
+        grid_width (int): width of grid
+        grid_height (int): height of grid
+        canvas_width (int): width of the canvas in pixels
+        canvas_height (int): height of the canvas in pixels
+        delta (boolean): send delta frames instead of the full grid every frame
+
+    """
+    # portrayal of an empty cell, without its label and position
+    EMPTY_PORTRAYAL = {
+        "Shape": "square", "Color": "white", "Filled": "true", "Layer": 0, "r": 0.5,
+        "text_color": "black"
+    }
+
     def __init__(
-        self, portrayal_method, grid_width, grid_height, canvas_width=500, canvas_height=500
+        self, portrayal_method, grid_width, grid_height, canvas_width=500, canvas_height=500,
+        delta=False
     ):
         super().__init__(portrayal_method, grid_width, grid_height, canvas_width, canvas_height)
+        self.delta = delta
+        if delta:
+            self.local_includes = ["DeltaCanvasModule.js"]
+            self.js_code = "elements.push(new DeltaCanvasModule({}, {}, {}, {}));".format(
+                canvas_width, canvas_height, grid_width, grid_height
+            )
+
+        # model of the previous frame, with its scores and occupied cells
+        self._model = None
+        self._scores = None
+        self._occupied = set()
+
+    def portray_cell(self, model, pos):
+        """Returns the portrayals of a cell: its obstacle, its customers, or an empty cell with
+        its score
+
+        Args:
+            model (CovidSupermarketModel): model to draw
+            pos (x, y): position of cell on grid
+
+        Returns:
+            portrayals (list of dicts): portrayals of the cell
+
+        """
+        x, y = pos
+        if not model.grid.walkable[pos]:
+            cell_objects = [model.get_obstacle(pos)]
+        else:
+            cell_objects = model.grid.get_cell_list_contents([pos])
+            if not cell_objects:
+                portrayal = dict(self.EMPTY_PORTRAYAL)
+                portrayal.update({
+                    "text": "({0}, {1}) - {2}".format(x, y, model.grid.get_score(pos)),
+                    "x": x, "y": y
+                })
+                return [portrayal]
+
+        portrayals = []
+        for obj in cell_objects:
+            portrayal = self.portrayal_method(obj)
+            if portrayal:
+                portrayal["x"] = x
+                portrayal["y"] = y
+                portrayals.append(portrayal)
+        return portrayals
 
     def render(self, model):
+        if self.delta:
+            return self.render_delta(model)
+
         grid_state = defaultdict(list)
         for x in range(model.grid.width):
             for y in range(model.grid.height):
-                cell_objects = model.grid.get_cell_list_contents([(x, y)])
-                score = model.grid.get_score((x, y))
-                if not cell_objects:
-
-                    portrayal = {
-                        "Shape": "square", "Color": "white", "Filled": "true", "Layer": 0, "r": 0.5,
-                        "text": "({0}, {1}) - {2}".format(x, y, score), "text_color": "black",
-                        "x": x, "y": y
-                    }
+                for portrayal in self.portray_cell(model, (x, y)):
                     grid_state[portrayal["Layer"]].append(portrayal)
-                for obj in cell_objects:
-                    portrayal = self.portrayal_method(obj)
-                    if portrayal:
-                        portrayal["x"] = x
-                        portrayal["y"] = y
-                        grid_state[portrayal["Layer"]].append(portrayal)
         return grid_state
 
+    def render_delta(self, model):
+        """Renders the cells that changed since the previous frame. Only cells with a customer
+        on them, now or in the previous frame, or whose score changed can change. Empty cells are
+        sent as their score only, the client labels them using the portrayal of an empty cell.
+        The first frame of a model is a full frame, the server creates a new model on every reset
+
+        Args:
+            model (CovidSupermarketModel): model to draw
+
+        Returns:
+            frame (dict): "full" is true for the first frame of a model. Full frames also contain
+                the portrayals of the obstacles ("static") and the portrayal of an empty cell
+                ("empty"). "cells" contains a list [x, y, portrayals] per changed cell with
+                customers, "scores" a list [x, y, score] per changed empty cell
+
+        """
+        scores = model.grid.scores
+        occupied = {customer.pos for customer in model.customers}
+
+        frame = {"full": model is not self._model, "cells": [], "scores": []}
+        if frame["full"]:
+            frame["static"] = []
+            for pos in zip(*[axis.tolist() for axis in np.nonzero(~model.grid.walkable)]):
+                frame["static"].extend(self.portray_cell(model, pos))
+            frame["empty"] = self.EMPTY_PORTRAYAL
+            changed = set(zip(*[axis.tolist() for axis in np.nonzero(model.grid.walkable)]))
+        else:
+            changed = occupied | self._occupied
+            changed.update(zip(*[
+                axis.tolist() for axis in np.nonzero((scores != self._scores) & model.grid.walkable)
+            ]))
+
+        for pos in changed:
+            if pos in occupied:
+                frame["cells"].append([pos[0], pos[1], self.portray_cell(model, pos)])
+            else:
+                frame["scores"].append([pos[0], pos[1], int(scores[pos])])
+
+        self._model = model
+        self._scores = scores.copy()
+        self._occupied = occupied
+        return frame
+
 
 class CanvasHeatGrid(CanvasGrid):
     """Overrides the default canvas grid to apply heat map for number of problematic contacts """
@@ -101,45 +199,34 @@ class CanvasHeatGrid(CanvasGrid):
 
     def render(self, model):
         grid_state = defaultdict(list)
-        high_cont_val = 0
 
         # determine what the maximum value of problematic contacts is which can be used for scaling
         # the colours of a heatmap.
-        for x in range(model.heatgrid.width):
-            for y in range(model.heatgrid.height):
-                if isinstance(model.heatgrid[x][y], float):
-                    if model.heatgrid[x][y] > high_cont_val:
-                        high_cont_val = model.heatgrid[x][y]
-
-        for x in range(model.heatgrid.width):
-            for y in range(model.heatgrid.height):
-                if isinstance(model.heatgrid[x][y], float):
-
-                    cell_color = color_gradient(high_cont_val, model.heatgrid[x][y])
-                    # print(cell_color, "cell color")
+        high_cont_val = model.heatgrid.max()
+
+        for x in range(model.grid.width):
+            for y in range(model.grid.height):
+                if model.heatgrid[x, y] > 0:
+
+                    cell_color = color_gradient(high_cont_val, model.heatgrid[x, y])
                     portrayal = {
                         "Shape": "rect", "Color": cell_color, "Filled": "true", "Layer": 0, "w": 1,
                         "h": 1, "x": x, "y": y
                     }
                     grid_state[portrayal["Layer"]].append(portrayal)
-                else:
-                    cell_objects = model.heatgrid.get_cell_list_contents([(x, y)])
-
-                    if not cell_objects:
-
-                        portrayal = {
-                            "Shape": "square", "Color": "white", "Filled": "true", "Layer": 0,
-                            "r": 0.5, "text": "({0}, {1}) - {2}".format(x, y, y),
-                            "text_color": "black", "x": x, "y": y
-                        }
+                elif not model.grid.walkable[x, y]:
+                    portrayal = self.portrayal_method(model.get_obstacle((x, y)))
+                    if portrayal:
+                        portrayal["x"] = x
+                        portrayal["y"] = y
                         grid_state[portrayal["Layer"]].append(portrayal)
-
-                    for obj in cell_objects:
-                        portrayal = self.portrayal_method(obj)
-                        if portrayal:
-                            portrayal["x"] = x
-                            portrayal["y"] = y
-                            grid_state[portrayal["Layer"]].append(portrayal)
+                else:
+                    portrayal = {
+                        "Shape": "square", "Color": "white", "Filled": "true", "Layer": 0,
+                        "r": 0.5, "text": "({0}, {1}) - {2}".format(x, y, y),
+                        "text_color": "black", "x": x, "y": y
+                    }
+                    grid_state[portrayal["Layer"]].append(portrayal)
 
         return grid_state
 
@@ -147,7 +234,7 @@ class CanvasHeatGrid(CanvasGrid):
 def agent_portrayal(agent):
     """Portrayal of Customers and Obstacles """
     portrayal = {}
-    if type(agent) == Customer:
+    if isinstance(agent, Customer):
         portrayal = {
             "Shape": "circle", "Filled": "true", "color": "yellow", "Layer":   0, "r": 0.9,
             "text_color": "white"
@@ -193,11 +280,11 @@ def heat_agent_portrayal(agent):
 
 
 # load supermarket floorplan for simulation
-floorplan = core.load_floorplan("data/albert_excel_test.csv")
+floorplan = floorplans.load("data/albert_excel_test.csv")
 width = len(floorplan)
 height = len(floorplan[0])
 
-grid = CanvasGridCustom(agent_portrayal, width, height, 800, 600)
+grid = CanvasGridCustom(agent_portrayal, width, height, 800, 600, delta=True)
 heatgrid = CanvasHeatGrid(heat_agent_portrayal, width, height, 800, 600)
 
 # no chart for the moment. Just leaving it here, because then it will be easy to make a new chart
@@ -1,13 +1,85 @@
 from mesa.space import MultiGrid
 from mesa.agent import Agent
 from typing import Tuple
-from agent import Customer, Obstacle
+import numpy as np
+
+from agent import Customer
 import core
 
 
+class CellIndex:
+    """Set of cells that supports adding, removing and sampling a uniformly random cell in
+    constant time. The cells are kept in a dense list with swap-remove, together with the index
+    of each cell in the list
+
+    Args:
+        cells (iterable, optional): initial cells
+
+    Attributes:
+        cells (list): cells in the index, in arbitrary order
+
+    """
+    def __init__(self, cells=()):
+        self.cells = []
+        self._index = {}
+        for cell in cells:
+            self.add(cell)
+
+    def __len__(self):
+        return len(self.cells)
+
+    def __contains__(self, cell):
+        return cell in self._index
+
+    def __iter__(self):
+        return iter(self.cells)
+
+    def add(self, cell):
+        """Adds a cell, if it is not in the index yet
+
+        Args:
+            cell (x, y): cell to add
+
+        """
+        if cell not in self._index:
+            self._index[cell] = len(self.cells)
+            self.cells.append(cell)
+
+    def discard(self, cell):
+        """Removes a cell, if it is in the index, by moving the last cell into its place
+
+        Args:
+            cell (x, y): cell to remove
+
+        """
+        index = self._index.pop(cell, None)
+        if index is None:
+            return
+
+        last = self.cells.pop()
+        if last != cell:
+            self.cells[index] = last
+            self._index[last] = index
+
+    def sample(self, random):
+        """Returns a uniformly random cell of the index
+
+        Args:
+            random (random.Random): random number generator to use
+
+        Returns:
+            cell (x, y): random cell, None if the index is empty
+
+        """
+        if not self.cells:
+            return None
+        return random.choice(self.cells)
+
+
 class SuperMarketGrid(MultiGrid):
     """A MESA MultiGrid with extra options. Each cell contains a score value depending on how
-    close customers are to that particular cell
+    close customers are to that particular cell. Obstacles are not placed as agents, but are
+    stored in a static layer of walkable cells
 
     Args:
         width (int): width of grid
@@ -22,7 +94,15 @@ class SuperMarketGrid(MultiGrid):
         torus (boolean): if grid wraps around on edges
         avoid_radius (int): radius in grid units in which customers try to avoid each other
         default_score (int): default score of grid cell
-        scores (dict {pos: score}): dict of grid cell score per pos
+        walkable (2D np array of bool): true for every cell without an obstacle
+        shelf_id (2D np array of int): type id of the obstacle per cell, -1 if walkable
+        scores (2D np array of int): grid cell score per pos, indexed as scores[x, y]
+        barrier_mask (2D np array of uint): per cell a bitmask of the offsets in the avoid_radius
+            diamond around it that are shielded from it by an obstacle
+        offset_bit (2D np array of int): bit of an offset (dx, dy) in barrier_mask, indexed as
+            offset_bit[dx + avoid_radius, dy + avoid_radius]
+        free_cells (CellIndex): walkable cells without agents
+        free_entrance (CellIndex): entrance cells without agents
 
     """
 
@@ -31,7 +111,174 @@ class SuperMarketGrid(MultiGrid):
 
         self.avoid_radius = avoid_radius
         self.default_score = default_score
-        self.scores = {}
+        self.scores = np.full((width, height), default_score, dtype=int)
+        self.walkable = np.ones((width, height), dtype=bool)
+        self.shelf_id = np.full((width, height), -1, dtype=int)
+
+        # score a single customer adds to the cells around it, indexed by offset + avoid_radius
+        self._score_kernel = np.maximum(
+            self.avoid_radius + 1 - self._diamond_distance(self.avoid_radius), 0
+        )
+        self._diamonds = {}
+
+        # number the offsets in the diamond, so a set of offsets fits in a single integer
+        diamond = self._diamond_distance(self.avoid_radius) <= self.avoid_radius
+        n_bits = int(diamond.sum())
+        if n_bits > 64:
+            raise ValueError(
+                "Avoid radius {} is too large for a 64 bit barrier mask.".format(avoid_radius)
+            )
+        self._mask_dtype = np.uint32 if n_bits <= 32 else np.uint64
+        self.offset_bit = np.zeros(diamond.shape, dtype=self._mask_dtype)
+        self.offset_bit.T[diamond.T] = np.arange(n_bits)
+        self.barrier_mask = np.zeros((width, height), dtype=self._mask_dtype)
+        self._masked_kernels = {0: self._score_kernel}
+        self._move_kernels = {}
+        self._walkable_neighbours = {}
+
+        self.free_cells = CellIndex(
+            (x, y) for x in range(width) for y in range(height)
+        )
+        self._entrance = set()
+        self.free_entrance = CellIndex()
+
+    @staticmethod
+    def _diamond_distance(radius):
+        """Manhattan distance to the center for each cell of a (2 * radius + 1)² window
+
+        Args:
+            radius (int): radius of window
+
+        Returns:
+            distance (2D np array of int): distance per offset, indexed by offset + radius
+
+        """
+        offsets = np.abs(np.arange(-radius, radius + 1))
+        return offsets[:, None] + offsets[None, :]
+
+    def _window(self, pos, radius):
+        """Returns the part of a (2 * radius + 1)² window around pos that lies on the grid
+
+        Args:
+            pos (x, y): center of window
+            radius (int): radius of window
+
+        Returns:
+            grid_slice (tuple of slices): window on the grid
+            window_slice (tuple of slices): corresponding part of the window
+
+        """
+        x, y = pos
+        x0, x1 = max(x - radius, 0), min(x + radius + 1, self.width)
+        y0, y1 = max(y - radius, 0), min(y + radius + 1, self.height)
+        grid_slice = (slice(x0, x1), slice(y0, y1))
+        window_slice = (slice(x0 - x + radius, x1 - x + radius),
+                        slice(y0 - y + radius, y1 - y + radius))
+
+        return grid_slice, window_slice
+
+    def set_obstacles(self, shelf_id, walkable):
+        """Sets the static obstacle layer of the grid. Obstacle cells are no longer empty and the
+        barriers between cells are compiled
+
+        Args:
+            shelf_id (2D np array of int): type id of the obstacle per cell
+            walkable (2D np array of bool): true for every cell without an obstacle
+
+        """
+        self.walkable = walkable
+        self._walkable_neighbours = {}
+        self.shelf_id = np.where(walkable, -1, shelf_id)
+        obstacle_cells = list(map(tuple, np.argwhere(~walkable).tolist()))
+        self.empties.difference_update(obstacle_cells)
+        for cell in obstacle_cells:
+            self.free_cells.discard(cell)
+        self.compile_barriers(~walkable)
+
+    def set_entrance(self, cells):
+        """Sets the cells in which agents enter the grid, see free_entrance
+
+        Args:
+            cells (list): entrance cells
+
+        """
+        self._entrance = set(cells)
+        self.free_entrance = CellIndex(cell for cell in cells if cell in self.free_cells)
+
+    def _place_agent(self, pos, agent):
+        """Places the agent in a cell and updates the free cell indices """
+        super()._place_agent(pos, agent)
+        self.free_cells.discard(pos)
+        self.free_entrance.discard(pos)
+
+    def _remove_agent(self, pos, agent):
+        """Removes the agent from a cell and updates the free cell indices """
+        super()._remove_agent(pos, agent)
+        if self.is_cell_empty(pos):
+            self.free_cells.add(pos)
+            if pos in self._entrance:
+                self.free_entrance.add(pos)
+
+    def get_walkable_neighbours(self, pos):
+        """Returns the walkable cells in the van Neumann neighbourhood of pos, in the order of
+        get_neighborhood. Obstacles never move, so the cells are computed once per position
+
+        Args:
+            pos (x, y): position on grid
+
+        Returns:
+            neighbours (list): walkable neighbouring cells
+
+        """
+        neighbours = self._walkable_neighbours.get(pos)
+        if neighbours is None:
+            x, y = pos
+            neighbours = []
+            for dx, dy in ((0, -1), (-1, 0), (1, 0), (0, 1)):
+                nx, ny = x + dx, y + dy
+                if 0 <= nx < self.width and 0 <= ny < self.height and self.walkable[nx, ny]:
+                    neighbours.append((nx, ny))
+            self._walkable_neighbours[pos] = neighbours
+
+        return neighbours
+
+    def compile_barriers(self, obstacles):
+        """Precomputes which cells are shielded from each other by obstacles, following the rules
+        in core.BARRIER_DICT. Obstacles never move, so this only has to be done once per floorplan
+
+        Args:
+            obstacles (2D np array of bool): true for every cell that contains an obstacle
+
+        """
+        self.barrier_mask[:] = 0
+        self._masked_kernels = {0: self._score_kernel}
+        self._move_kernels = {}
+        for (dx, dy), delta_pos_list in core.BARRIER_DICT.items():
+
+            # cells that have an obstacle at relative position (dx, dy)
+            blocked = np.zeros((self.width, self.height), dtype=self._mask_dtype)
+            x0, x1 = max(-dx, 0), min(self.width - dx, self.width)
+            y0, y1 = max(-dy, 0), min(self.height - dy, self.height)
+            blocked[x0:x1, y0:y1] = obstacles[x0 + dx:x1 + dx, y0 + dy:y1 + dy]
+
+            for sx, sy in delta_pos_list:
+                if abs(sx) + abs(sy) <= self.avoid_radius:
+                    bit = self.offset_bit[sx + self.avoid_radius, sy + self.avoid_radius]
+                    self.barrier_mask |= blocked << bit
+
+    def is_shielded(self, pos, delta_pos):
+        """Returns if the cell at relative position delta_pos is shielded from pos by an obstacle
+
+        Args:
+            pos (x, y or arrays of x and y): position(s) on grid
+            delta_pos (dx, dy or arrays of dx and dy): relative position(s), within avoid_radius
+
+        Returns:
+            shielded (bool or np array of bool): if the relative position is shielded
+
+        """
+        bit = self.offset_bit[delta_pos[0] + self.avoid_radius, delta_pos[1] + self.avoid_radius]
+        return (self.barrier_mask[pos[0], pos[1]] >> bit) & 1 == 1
 
     def set_score(self, pos, score):
         """Assigns a new score value to a grid position
@@ -43,27 +290,68 @@ class SuperMarketGrid(MultiGrid):
         """
         self.scores[pos] = score
 
-    def _set_score(self, agent, new_pos, score_formula):
-        """Assigns a new score value to a grid position. Private function, scores should be
-        handled internally
+    def _masked_kernel(self, mask):
+        """Returns the score kernel without the offsets that are shielded according to mask.
+        Cells with the same barrier mask share the same masked kernel
+
+        Args:
+            mask (uint): barrier mask of a cell
+
+        Returns:
+            kernel (2D np array of int): score per offset, indexed by offset + avoid_radius
+
+        """
+        kernel = self._masked_kernels.get(mask)
+        if kernel is None:
+            shielded = (mask >> self.offset_bit) & 1 == 1
+            kernel = np.where(shielded, 0, self._score_kernel)
+            self._masked_kernels[mask] = kernel
+
+        return kernel
+
+    def _move_kernel(self, pos, new_pos):
+        """Returns the change of the scores when an agent moves from pos to an adjacent cell
+        new_pos, i.e. the masked kernel of new_pos minus the masked kernel of pos. With the
+        linear score kernel every cell in both diamonds changes, so this covers their union
+
+        Args:
+            pos (x, y): current position of agent on grid
+            new_pos (x, y): new position of agent on grid, at most one cell away on each axis
+
+        Returns:
+            kernel (2D np array of int): change of the score per offset from pos, indexed by
+                offset + avoid_radius + 1
+
+        """
+        dx, dy = new_pos[0] - pos[0], new_pos[1] - pos[1]
+        key = (self.barrier_mask[pos], self.barrier_mask[new_pos], dx, dy)
+        kernel = self._move_kernels.get(key)
+        if kernel is None:
+            size = 2 * self.avoid_radius + 1
+            kernel = np.zeros((size + 2, size + 2), dtype=int)
+            kernel[1:size + 1, 1:size + 1] -= self._masked_kernel(key[0])
+            kernel[1 + dx:size + 1 + dx, 1 + dy:size + 1 + dy] += self._masked_kernel(key[1])
+            self._move_kernels[key] = kernel
+
+        return kernel
+
+    def _set_score(self, agent, new_pos, sign):
+        """Adds (sign=1) or subtracts (sign=-1) the score kernel of an agent around a grid
+        position. Cells shielded from new_pos by obstacles are left untouched. Private function,
+        scores should be handled internally
 
         Args:
             agent (Customer): customer object to set score for
             new_pos (x, y): new positon of agent on grid
-            score_formula (lambda function): how to calculate score
+            sign (int <- {-1, 1}): add or subtract the score of the agent
 
         """
-        neighbors = self.get_neighbors(
-            new_pos, moore=False, include_center=True, radius=self.avoid_radius
-        )
-        safe_pos = self.get_safe_pos(neighbors, agent, new_pos)
-
-        affected_cells = self.get_neighborhood(new_pos, moore=False, include_center=True,
-                                               radius=self.avoid_radius)
-        for cell in affected_cells:
-            if cell not in safe_pos:
-                score = score_formula(new_pos, cell)
-                self.scores[cell] = score
+        kernel = self._masked_kernel(self.barrier_mask[new_pos])
+        grid_slice, window_slice = self._window(new_pos, self.avoid_radius)
+        if sign > 0:
+            self.scores[grid_slice] += kernel[window_slice]
+        else:
+            self.scores[grid_slice] -= kernel[window_slice]
 
     def get_score(self, cells):
         """Returns the score value corresponding to the given position(s)
@@ -76,15 +364,12 @@ class SuperMarketGrid(MultiGrid):
 
         """
         if type(cells) is tuple:
-            cells = [cells]
+            return int(self.scores[cells])
 
         score = 0
         for cell in cells:
-            if cell in self.scores:
-                score += self.scores[cell]
-            else:
-                score += self.default_score
-        return score
+            score += self.scores[cell]
+        return int(score)
 
     def get_forbidden_cells(self, pos, radius, threshold=0, agent_on_location=True):
         """Returns all the cells with a crowded score higher than the given threshold value
@@ -94,19 +379,28 @@ class SuperMarketGrid(MultiGrid):
             radius (int): radius from agent
 
         """
-        forbidden = []
-        cells = self.get_neighborhood(pos, moore=False, include_center=True, radius=radius)
-        for cell in cells:
+        if radius not in self._diamonds:
+            distance = self._diamond_distance(radius)
+
+            # offsets of the diamond, in the same order as get_neighborhood lists the cells
+            dy, dx = np.nonzero((distance <= radius).T)
+            dx, dy = dx - radius, dy - radius
+
             # correct for the agent's own crowded score if there is a agent on the given location
-            correction = 0
-            if agent_on_location:
-                distance = core.get_distance(pos, cell)
-                if distance <= self.avoid_radius:
-                    correction = self.avoid_radius + 1 - distance
-            if self.get_score(cell) > threshold + correction:
-                forbidden.append(cell)
+            correction = np.maximum(self.avoid_radius + 1 - np.abs(dx) - np.abs(dy), 0)
+            self._diamonds[radius] = (dx, dy, correction)
+        dx, dy, correction = self._diamonds[radius]
+
+        x, y = pos
+        xs, ys = dx + x, dy + y
+        if not (radius <= x < self.width - radius and radius <= y < self.height - radius):
+            inside = (xs >= 0) & (xs < self.width) & (ys >= 0) & (ys < self.height)
+            xs, ys, correction = xs[inside], ys[inside], correction[inside]
 
-        return forbidden
+        limit = threshold + correction if agent_on_location else threshold
+        forbidden = self.scores[xs, ys] > limit
+
+        return list(zip(xs[forbidden].tolist(), ys[forbidden].tolist()))
 
     def _add_agent_score(self, agent, new_pos):
         """Internal function: updates the crowdedness scores when agent is moving to a new cell
@@ -116,9 +410,7 @@ class SuperMarketGrid(MultiGrid):
             new_pos (x, y): new positon of agent on grid
 
         """
-        score_formula = lambda pos, cell: self.avoid_radius - (
-                core.get_distance(new_pos, cell, "manhattan") - 1) + self.get_score(cell)
-        self._set_score(agent, new_pos, score_formula)
+        self._set_score(agent, new_pos, 1)
 
     def _remove_agent_score(self, agent, pos):
         """Internal function: updates the crowdedness scores when agent is moving to a new cell
@@ -128,9 +420,29 @@ class SuperMarketGrid(MultiGrid):
             pos (x, y): current position of agent on grid
 
         """
-        score_formula = lambda pos, cell: -self.avoid_radius + (
-                core.get_distance(pos, cell, "manhattan") - 1) + self.get_score(cell)
-        self._set_score(agent, pos, score_formula)
+        self._set_score(agent, pos, -1)
+
+    def _move_agent_score(self, agent, pos, new_pos):
+        """Internal function: updates the crowdedness scores when agent moves from pos to
+        new_pos. Moves to an adjacent cell only apply the difference between the kernels of both
+        positions, other moves remove and add the whole kernel
+
+        Args:
+            agent (Customer): customer object to move the score of
+            pos (x, y): current position of agent on grid
+            new_pos (x, y): new position of agent on grid
+
+        """
+        if pos == new_pos:
+            return
+
+        if abs(new_pos[0] - pos[0]) > 1 or abs(new_pos[1] - pos[1]) > 1:
+            self._remove_agent_score(agent, pos)
+            self._add_agent_score(agent, new_pos)
+            return
+
+        grid_slice, window_slice = self._window(pos, self.avoid_radius + 1)
+        self.scores[grid_slice] += self._move_kernel(pos, new_pos)[window_slice]
 
     def place_agent(self, agent, pos):
         """Places the agent on a given position in the grid and updates the crowdedness score
@@ -143,7 +455,7 @@ class SuperMarketGrid(MultiGrid):
         super().place_agent(agent, pos)
 
         # update score
-        if type(agent) is Customer:
+        if isinstance(agent, Customer):
             self._add_agent_score(agent, pos)
 
     def remove_agent(self, agent):
@@ -157,27 +469,21 @@ class SuperMarketGrid(MultiGrid):
         super().remove_agent(agent)
 
         # update score
-        if type(agent) is Customer:
+        if isinstance(agent, Customer):
             self._remove_agent_score(agent, pos)
 
-    def get_safe_pos(self, neighbors, agent, pos):
-        """Returns positions without any obstacles
+    def get_safe_pos(self, pos):
+        """Returns positions that are shielded from pos by obstacles
 
         Args:
-            neighbors (list): neighbors of agent
-            agent (Customer): customer object to get safe position for
             pos (x, y): position of agent on grid
 
         """
         safe_pos = []
-        for neighbor in neighbors:
-            if type(neighbor) is Obstacle:
-                delta_pos = (neighbor.pos[0] - pos[0], neighbor.pos[1] - pos[1])
-                if delta_pos in core.BARRIER_DICT:
-                    delta_pos_list = core.BARRIER_DICT[delta_pos]
-                    real_pos = list([(pos[0] + delta_pos[0], pos[1]
-                                      + delta_pos[1]) for delta_pos in delta_pos_list])
-                    safe_pos += real_pos
+        for delta_pos, delta_pos_list in core.BARRIER_DICT.items():
+            obstacle_pos = (pos[0] + delta_pos[0], pos[1] + delta_pos[1])
+            if not self.out_of_bounds(obstacle_pos) and not self.walkable[obstacle_pos]:
+                safe_pos += [(pos[0] + dx, pos[1] + dy) for dx, dy in delta_pos_list]
 
         return safe_pos
 
@@ -189,7 +495,6 @@ class SuperMarketGrid(MultiGrid):
             new_pos (x, y): new position of agent on grid
 
         """
-        if type(agent) is Customer:
-            self._remove_agent_score(agent, agent.pos)
-            self._add_agent_score(agent, new_pos)
+        if isinstance(agent, Customer):
+            self._move_agent_score(agent, agent.pos, tuple(new_pos))
         super().move_agent(agent, new_pos)
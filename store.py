@@ -0,0 +1,108 @@
+import json
+import os
+import numpy as np
+import pandas as pd
+
+
+class ResultStore:
+    """Append-only store for the results of a sweep, kept as a single structured record file.
+    The records have a fixed size and are stored one after the other (a NumPy structured array),
+    the names and types of their fields are kept in a json header next to it. Loading memory maps
+    the file, so selecting a single parameter or step range does not parse the whole sweep
+
+    Args:
+        path (string): path of the data file, the header is stored at path + ".json"
+        columns (list of (name, dtype) tuples, optional): columns of the store, required if the
+            store does not exist yet
+
+    Attributes:
+        path (string): path of the data file
+        dtype (np.dtype): structured dtype of a single record
+
+    Raises:
+        ValueError: if the store does not exist and no columns are given, or if the given
+            columns do not match the columns of an existing store
+
+    """
+    def __init__(self, path, columns=None):
+        self.path = path
+        header_path = path + ".json"
+
+        if os.path.exists(header_path):
+            with open(header_path) as file:
+                stored = [tuple(column) for column in json.load(file)["columns"]]
+            if columns is not None and np.dtype(columns) != np.dtype(stored):
+                raise ValueError(
+                    "Columns {} do not match the columns {} of store {}."
+                    .format(columns, stored, path)
+                )
+            columns = stored
+        elif columns is None:
+            raise ValueError("Store {} does not exist, specify its columns.".format(path))
+        else:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            with open(header_path, "w") as file:
+                json.dump({"columns": [[name, np.dtype(dtype).str] for name, dtype in columns]},
+                          file)
+
+        self.dtype = np.dtype([(name, dtype) for name, dtype in columns])
+
+    def __len__(self):
+        if not os.path.exists(self.path):
+            return 0
+        return os.path.getsize(self.path) // self.dtype.itemsize
+
+    def append(self, **columns):
+        """Appends records to the store. Columns can be given as arrays or as single values,
+        which are repeated for every record
+
+        Args:
+            **columns: values of all columns of the store
+
+        """
+        values = np.broadcast_arrays(*[np.asarray(columns[name]) for name in self.dtype.names])
+        records = np.empty(values[0].shape, dtype=self.dtype).ravel()
+        for name, value in zip(self.dtype.names, values):
+            records[name] = value.ravel()
+
+        with open(self.path, "ab") as file:
+
+            # drop a record that was cut off while being written, so the records stay aligned
+            file.truncate(len(self) * self.dtype.itemsize)
+            records.tofile(file)
+            file.flush()
+
+    def load(self, steps=None, **selection):
+        """Loads the records of the store, optionally only a selection of them
+
+        Args:
+            steps (tuple (int, int), optional): only load records with start <= step < stop
+            **selection: only load records with the given value (or one of a list of values)
+                in a column, e.g. parameter="vision"
+
+        Returns:
+            records (np structured array): selected records
+
+        """
+        n_records = len(self)
+        if n_records == 0:
+            return np.empty(0, dtype=self.dtype)
+
+        # a record that was cut off while being written is ignored
+        records = np.memmap(self.path, dtype=self.dtype, mode="r", shape=(n_records,))
+        mask = np.ones(n_records, dtype=bool)
+        if steps is not None:
+            mask &= (records["step"] >= steps[0]) & (records["step"] < steps[1])
+        for name, value in selection.items():
+            mask &= np.isin(records[name], value)
+
+        return np.array(records[mask])
+
+    def load_dataframe(self, steps=None, **selection):
+        """Loads the records of the store as a pandas DataFrame, see load()
+
+        Returns:
+            data (pd.DataFrame): selected records
+
+        """
+        return pd.DataFrame(self.load(steps, **selection))
@@ -0,0 +1,54 @@
+import numpy as np
+import pytest
+
+from model import CovidSupermarketModel
+import floorplan as floorplans
+
+
+FLOORPLAN = floorplans.load("data/albert_excel_test.csv")
+
+
+def count_contacts(model, method):
+    """Counts the problematic contacts of the current state of a model, without changing its
+    heat map
+
+    Args:
+        model (CovidSupermarketModel): model to count the contacts of
+        method (string): name of the method of the model that counts the contacts
+
+    Returns:
+        n_problematic_contacts (int): number of problematic contacts
+        flags (list of booleans): is_problematic_contact per customer
+        heat (2D np array of float): increment of the heat map
+
+    """
+    heatgrid = model.heatgrid.copy()
+    getattr(model, method)()
+    heat = model.heatgrid - heatgrid
+    model.heatgrid = heatgrid
+
+    flags = [customer.is_problematic_contact for customer in model.customers]
+    return model.n_problematic_contacts, flags, heat
+
+
+@pytest.mark.parametrize("population_store", [False, True])
+@pytest.mark.parametrize("seed, vaccination_prop", [(0, 0.0), (1, 0.3), (2, 0.7)])
+def test_problematic_contacts_match_loop(seed, vaccination_prop, population_store):
+    model = CovidSupermarketModel(
+        FLOORPLAN, FLOORPLAN.width, FLOORPLAN.height, N_customers=120,
+        vaccination_prop=vaccination_prop, population_store=population_store, seed=seed
+    )
+
+    n_contacts = 0
+    for step in range(60):
+        model.step()
+        n, flags, heat = count_contacts(model, "problematic_contacts")
+        n_loop, flags_loop, heat_loop = count_contacts(model, "problematic_contacts_loop")
+
+        assert n == n_loop, "step {}".format(step)
+        assert flags == flags_loop, "step {}".format(step)
+        np.testing.assert_array_equal(heat, heat_loop, "step {}".format(step))
+        n_contacts += n
+
+    # the comparison only means something if there were contacts to count
+    assert n_contacts > 0